@@ -2,17 +2,29 @@
 Command line interface for rnabam2cov.
 """
 import argparse
+import os
 import sys
-from pathlib import Path
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Union
 
-from rnabam2cov.coverage import FileType, get_stranded_coverage
-from rnabam2cov.strandedness import LibraryType, get_output_prefixes
+from rnabam2cov.coverage import (
+    BAM_THREADS,
+    PARALLEL_MIN_READS,
+    THREADS,
+    FileType,
+    get_stranded_coverage,
+    get_stranded_coverage_both_strands,
+)
+from rnabam2cov.strandedness import LibraryType, get_output_prefixes, get_strand_mapping
+
+# Valid values of string parameters, checked by validate_parameters
+_VALID_LIBTYPES = frozenset(lt.value for lt in LibraryType)
+_VALID_STRANDS = frozenset({"+", "-"})
 
 
 def validate_parameters(
     bam_path: str,
-    libtype: str,
+    libtype: Union[str, LibraryType],
     strands: List[str],
     split: bool,
     pc: bool,
@@ -28,8 +40,9 @@ def validate_parameters(
     Validate input parameters before processing.
     
     Args:
-        bam_path: Path to input BAM file
-        libtype: Library type ('forward' or 'reverse')
+        bam_path: Path to input BAM file. Unused, as the BAM is checked when it is opened (a missing file raises
+                  FileNotFoundError). Kept for API compatibility
+        libtype: Library type ('forward' or 'reverse', or the corresponding LibraryType)
         strands: List of strands to process ('+' and/or '-')
         split: Treat "split" BAM entries as distinct intervals when computing coverage
         pc: Calculate coverage of paired-end fragments (BAM only)
@@ -43,22 +56,15 @@ def validate_parameters(
     
     Raises:
         ValueError: If any parameters are invalid
-        FileNotFoundError: If input BAM file does not exist
     """
-    # Validate BAM file
-    if not Path(bam_path).exists():
-        raise FileNotFoundError(f"Input BAM file not found: {bam_path}")
-    
-    # Validate library type
-    
-    valid_types = [lt.value for lt in LibraryType]
-    if libtype not in valid_types:
+    # Validate library type (LibraryType members are valid by construction)
+    if not isinstance(libtype, LibraryType) and libtype not in _VALID_LIBTYPES:
+        valid_types = [lt.value for lt in LibraryType]
         raise ValueError(f"Invalid library type '{libtype}'. Valid options are: {', '.join(valid_types)}")
     
     # Validate strands
-    valid_strands = ['+', '-']
     for strand in strands:
-        if strand not in valid_strands:
+        if strand not in _VALID_STRANDS:
             raise ValueError(f"Invalid strand '{strand}'. Valid options are: '+' and '-'")
     
     # Validate mutually exclusive options
@@ -72,14 +78,14 @@ def validate_parameters(
         raise ValueError("Options 'five_prime' and 'three_prime' are mutually exclusive")
     
     # Validate file type
-    valid_file_types = [ft.value for ft in FileType]
-    if file_type.value not in valid_file_types:
+    if not isinstance(file_type, FileType):
+        valid_file_types = [ft.value for ft in FileType]
         raise ValueError(f"Invalid file type '{file_type}'. Valid options are: {', '.join(valid_file_types)}")
 
 
 def rnabam2cov(
-    bam_path: str,
-    libtype: str,
+    bam_path: Union[str, os.PathLike],
+    libtype: Union[str, LibraryType],
     output_prefix: str,
     strands: List[str] = ["+", "-"],
     split: bool = True,
@@ -95,14 +101,18 @@ def rnabam2cov(
     three_prime: bool = False,
     trackline: bool = False,
     trackopts: Optional[str] = None,
-    file_type: FileType = FileType.BEDGRAPH
+    file_type: FileType = FileType.BEDGRAPH,
+    compress: bool = False,
+    bam_threads: int = BAM_THREADS,
+    threads: int = THREADS,
+    use_bedtools: bool = True
 ) -> List[str]:
     """
     Generate strand-specific coverage files from a BAM file.
     
     Args:
         bam_path: Path to input BAM file
-        libtype: Library type ('forward' or 'reverse')
+        libtype: Library type ('forward' or 'reverse', or the corresponding LibraryType)
         output_prefix: Prefix for output files
         strands: List of strands to process ('+' and/or '-')
         split: Treat "split" BAM entries as distinct intervals when computing coverage
@@ -113,16 +123,30 @@ def rnabam2cov(
         scale: Scale coverage by a constant factor
         bg: Report coverage in bedgraph format
         bga: Report coverage in bedgraph format, including regions with zero coverage
-        max_depth: Combine all positions with depth >= max_depth
+        max_depth: Combine all positions with depth >= max_depth. Has no effect, as bedtools genomecov
+                   ignores this for bedgraph output (kept for compatibility)
         five_prime: Calculate coverage of 5' positions only
         three_prime: Calculate coverage of 3' positions only
         trackline: Add UCSC track line definition
         trackopts: Additional track line parameters
         file_type: Type of output file
+        compress: gzip compress output files (adds a '.gz' extension)
+        bam_threads: Number of threads used to decompress the BAM file. With bedtools, per strand using samtools
+                     (if available), otherwise the htslib threads of the single in-process BAM reader. 0 to disable
+        threads: Number of processes used to compute coverage of contigs in parallel (in-process only, requires an
+                 indexed BAM with at least PARALLEL_MIN_READS mapped reads). 1 to disable
+        use_bedtools: Compute coverage with bedtools genomecov. False to compute coverage in-process, with a single pass
+                      over the BAM for both strands (experimental, not supported with pc/fs)
         
     Returns:
         List of paths to generated coverage files
+        
+    Raises:
+        ValueError: If any parameters are invalid
+        FileNotFoundError: If input BAM file does not exist
     """
+    # Convert once, rather than for each strand
+    bam_path = os.fspath(bam_path)
     
     validate_parameters(
         bam_path=bam_path,
@@ -142,40 +166,79 @@ def rnabam2cov(
     # Get output prefixes based on library type
     output_prefixes = get_output_prefixes(output_prefix, libtype)
     
-    output_files = []
-    
-    for strand in strands:
-        # Get the appropriate output prefix for this strand based on library type
-        strand_prefix = output_prefixes[strand]
+    coverage_kwargs = dict(
+        bam_path=bam_path,
+        file_type=file_type,
+        split=split,
+        pc=pc,
+        fs=fs,
+        du=du,
+        ignoreD=ignoreD,
+        scale=scale,
+        bg=bg,
+        bga=bga,
+        max_depth=max_depth,
+        five_prime=five_prime,
+        three_prime=three_prime,
+        trackline=trackline,
+        trackopts=trackopts,
+        compress=compress,
+        bam_threads=bam_threads,
+        threads=threads,
+        use_bedtools=use_bedtools
+    )
+
+    # In-process, both strands are computed with a single pass over the BAM (unless bedtools-only options are set)
+    if set(strands) == {"+", "-"} and not (use_bedtools or pc or fs):
+        strand_mapping = get_strand_mapping(libtype)
+        transcribed_prefixes = {strand_mapping[strand]: prefix for strand, prefix in output_prefixes.items()}
+        del coverage_kwargs["pc"], coverage_kwargs["fs"], coverage_kwargs["use_bedtools"]
         
-        # Generate the coverage file for this strand
-        output_file = get_stranded_coverage(
-            bam_path=bam_path,
-            strand=strand,
-            output_prefix=strand_prefix,
-            file_type=file_type,
-            split=split,
-            pc=pc,
-            fs=fs,
-            du=du,
-            ignoreD=ignoreD,
-            scale=scale,
-            bg=bg,
-            bga=bga,
-            max_depth=max_depth,
-            five_prime=five_prime,
-            three_prime=three_prime,
-            trackline=trackline,
-            trackopts=trackopts
+        strand_outputs = get_stranded_coverage_both_strands(
+            output_prefix_plus=transcribed_prefixes["+"],
+            output_prefix_minus=transcribed_prefixes["-"],
+            libtype=libtype,
+            **coverage_kwargs
         )
         
-        output_files.append(output_file)
+        return [strand_outputs[strand] for strand in strands]
+
+    # Duplicated strands are only computed once, as they would write to the same output file
+    unique_strands = list(dict.fromkeys(strands))
+    
+    if len(unique_strands) <= 1:
+        strand_outputs = {
+            strand: get_stranded_coverage(strand=strand, output_prefix=output_prefixes[strand], **coverage_kwargs)
+            for strand in unique_strands
+        }
+        return [strand_outputs[strand] for strand in strands]
+
+    # Strands are independent (each is a separate genomecov run over the BAM), so generate them concurrently
+    # (each in a single process, so process pools aren't nested)
+    coverage_kwargs["threads"] = 1
+    strand_outputs = {}
+    with ProcessPoolExecutor(max_workers=len(unique_strands)) as executor:
+        futures = {
+            executor.submit(
+                get_stranded_coverage,
+                strand=strand,
+                output_prefix=output_prefixes[strand],
+                **coverage_kwargs
+            ): strand
+            for strand in unique_strands
+        }
+
+        for future in as_completed(futures):
+            strand_outputs[futures[future]] = future.result()
+
+    # Report output files in the order strands were requested
+    output_files = [strand_outputs[strand] for strand in strands]
     
     return output_files
 
 
 def parse_args(args=None):
-    """Parse command line arguments."""
+    """Parse command line arguments (from sys.argv if args is None)."""
     parser = argparse.ArgumentParser(
         description="Generate strand-specific coverage files from RNA-seq BAM files."
     )
@@ -257,7 +320,7 @@ def parse_args(args=None):
     parser.add_argument(
         "--max-depth", 
         type=int, 
-        help="Combine all positions with depth >= max-depth"
+        help="Combine all positions with depth >= max-depth. Has no effect, as bedtools genomecov ignores this for bedgraph output"
     )
     
     # Mutually exclusive group for 5'/3' options
@@ -282,18 +345,53 @@ def parse_args(args=None):
         "--trackopts", 
         help="Additional track line parameters (e.g. 'name=\"My Track\" visibility=2')"
     )
+    parser.add_argument(
+        "--compress", 
+        action="store_true", 
+        help="gzip compress output files (<prefix>.plus.bedgraph.gz etc.). Uses bgzip or pigz if available"
+    )
+    parser.add_argument(
+        "--bam-threads", 
+        type=int, 
+        default=BAM_THREADS,
+        help=(
+            f"Number of threads used to decompress the input BAM (default: {BAM_THREADS}). With bedtools, samtools "
+            "(if available) decompresses the BAM for each strand and streams it to bedtools. With --in-process, "
+            "the number of htslib threads of the single BAM reader. 0 to disable"
+        )
+    )
+    parser.add_argument(
+        "--threads", 
+        type=int, 
+        default=THREADS,
+        help=(
+            f"Number of processes used to compute coverage of contigs in parallel with --in-process (default: {THREADS}). "
+            f"Only used if the input BAM is indexed, with at least {PARALLEL_MIN_READS:,} mapped reads on more "
+            "than one contig. 1 to disable"
+        )
+    )
+    parser.add_argument(
+        "--in-process", 
+        action="store_false", 
+        dest="use_bedtools",
+        help="Compute coverage in-process with a single pass over the (coordinate-sorted) BAM for both strands, "
+             "rather than with bedtools genomecov (experimental, not supported with --pc/--fs)"
+    )
+    
+    if args is None:
+        args = sys.argv[1:]
     
     # exit with help message if no arguments provided
-    if len(sys.argv) == 1:
+    if not args:
         parser.print_help()
         parser.exit()
     
     return parser.parse_args(args)
 
 
-def main():
-    """Main entry point for the CLI."""
-    args = parse_args()
+def main(argv=None):
+    """Main entry point for the CLI (arguments are taken from sys.argv if argv is None)."""
+    args = parse_args(argv)
     
     try:        
         # Set bg/bga based on args
@@ -306,8 +404,8 @@ def main():
             
         # Call the wrapper function
         output_files = rnabam2cov(
-            bam_path=str(args.input),
-            libtype=args.libtype,
+            bam_path=args.input,
+            libtype=LibraryType(args.libtype),
             output_prefix=args.output_prefix,
             strands=args.strand,
             split=args.split,
@@ -322,7 +420,11 @@ def main():
             five_prime=args.five_prime,
             three_prime=args.three_prime,
             trackline=args.trackline,
-            trackopts=args.trackopts
+            trackopts=args.trackopts,
+            compress=args.compress,
+            bam_threads=args.bam_threads,
+            threads=args.threads,
+            use_bedtools=args.use_bedtools
         )
         
         print(f"Generated {len(output_files)} coverage files:")
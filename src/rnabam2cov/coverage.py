@@ -1,10 +1,77 @@
 """
 Functions for extracting strand-specific coverage from RNA-seq BAM files.
 """
+import gzip
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, suppress
 from enum import Enum
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
-from typing import Optional, Union
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+import numpy as np
 import pybedtools
+import pysam
+
+from rnabam2cov.strandedness import LibraryType, get_strand_mapping
+from rnabam2cov.utils import coverage_runs, difference_array, write_bedgraph
+
+# Number of threads used by bgzip/pigz when compressing output
+COMPRESS_THREADS = 4
+
+# Default number of threads used (by samtools or htslib via pysam) to decompress input BAM files
+BAM_THREADS = max(2, (os.cpu_count() or 1) // 4)
+
+# Number of threads used to decompress the BAM in each worker process when computing coverage of contigs in parallel
+# (kept low, as the workers themselves use the available CPUs)
+_WORKER_BAM_THREADS = 1
+
+# Default number of processes used to compute coverage of contigs in parallel
+THREADS = max(1, (os.cpu_count() or 1) // 2)
+
+# Minimum number of mapped reads for contigs to be processed in parallel
+# (below this, starting worker processes costs more than it saves)
+PARALLEL_MIN_READS = 1_000_000
+
+# Number of batches of contigs per worker process, so the batch with the largest contigs doesn't hold up the rest
+_BATCHES_PER_WORKER = 4
+
+# BAM file opened by each worker process when computing coverage of contigs in parallel (see _init_worker)
+_worker_bam = None
+
+# bedtools genomecov arguments corresponding to boolean flags of get_stranded_bedgraph (set if True)
+_FLAG_MAP = (
+    ("split", "split"),
+    ("pc", "pc"),
+    ("fs", "fs"),
+    ("du", "du"),
+    ("ignoreD", "ignoreD"),
+    ("bg", "bg"),
+    ("bga", "bga"),
+    ("trackline", "trackline"),
+    ("five_prime", "5"),
+    ("three_prime", "3"),
+)
+
+# bedtools genomecov arguments corresponding to valued options of get_stranded_bedgraph (set if not None/empty)
+_VAL_MAP = (
+    ("max_depth", "max"),
+    ("trackopts", "trackopts"),
+)
+
+# bedtools genomecov command, to which input and options are appended
+_GENOMECOV_ARGV = ("bedtools", "genomecov")
+
+# Buffer size used when copying file contents in Python
+COPY_BUFSIZE = 1 << 20
+
+# CIGAR operations for bases aligned to the reference (M, =, X)
+_CIGAR_ALIGNED = (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF)
 
 
 class FileType(Enum):
@@ -28,8 +95,787 @@ def get_file_extension(file_type: FileType) -> str:
     return extensions[file_type]
 
 
+def _genomecov_options(strand: str, options: Dict[str, object]) -> List[str]:
+    """
+    Get bedtools genomecov command line options (excluding the input) for get_stranded_bedgraph arguments.
+    
+    Args:
+        strand: Strand to extract ('+' or '-')
+        options: Arguments of get_stranded_bedgraph, by name
+        
+    Returns:
+        Command line options for bedtools genomecov
+    """
+    argv = ["-strand", strand]
+    argv.extend(f"-{key}" for arg, key in _FLAG_MAP if options[arg])
+    for arg, key in _VAL_MAP:
+        if options[arg]:
+            argv.extend((f"-{key}", str(options[arg])))
+    if options["scale"] != 1.0:
+        argv.extend(("-scale", str(options["scale"])))
+    return argv
+
+
+def _genomecov_argv(bam_path: str, options: List[str]) -> List[str]:
+    """
+    Get the bedtools genomecov command line for a BAM file.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        options: Command line options for bedtools genomecov (see _genomecov_options)
+        
+    Returns:
+        Command line arguments for subprocess
+    """
+    return [*_GENOMECOV_ARGV, "-ibam", bam_path, *options]
+
+
+def _copy_file(src_path: str, dst_path: str) -> None:
+    """
+    Copy the contents of a file, within the kernel (os.sendfile) where supported.
+    
+    Args:
+        src_path: Path to the file to copy
+        dst_path: Path to write the copy to
+    """
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # sendfile is unavailable (e.g. Windows) or not supported between these files
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
+def _compressor_argv(threads: int = COMPRESS_THREADS) -> Optional[List[str]]:
+    """
+    Get the command line for a multi-threaded gzip-compatible compressor available on the PATH.
+    
+    bgzip is preferred (output is also indexable with tabix), followed by pigz.
+    
+    Args:
+        threads: Number of compression threads
+        
+    Returns:
+        Command line to compress stdin to stdout, or None if neither bgzip nor pigz is available
+    """
+    if shutil.which("bgzip"):
+        return ["bgzip", "-@", str(threads), "-c"]
+    if shutil.which("pigz"):
+        return ["pigz", "-p", str(threads), "-c"]
+    return None
+
+
+def _samtools_view_argv(bam_path: str, threads: int, regions: Optional[List[str]] = None) -> List[str]:
+    """
+    Get the command line to decompress a BAM file with multiple threads, writing uncompressed BAM to stdout.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        threads: Number of additional decompression threads
+        regions: Only output reads from these contigs (requires an indexed BAM)
+        
+    Returns:
+        Command line arguments for subprocess
+    """
+    # Braces stop samtools parsing ':' or '-' in contig names (e.g. HLA-A*01:01:01:01) as a region range
+    return ["samtools", "view", "-@", str(threads), "-u", bam_path] + [f"{{{contig}}}" for contig in regions or []]
+
+
+def _run_pipeline(commands: List[List[str]], output_path: str, gzip_output: bool = False) -> None:
+    """
+    Run a pipeline of commands (as in a shell 'cmd1 | cmd2 | ...'), writing final output to output_path.
+    
+    Args:
+        commands: Command lines for each stage of the pipeline, in order
+        output_path: Path to write output of the final stage to
+        gzip_output: Compress output of the final stage in-process with the gzip module
+        
+    Raises:
+        RuntimeError: If any stage of the pipeline exits with a non-zero status
+        OSError: If a stage can't be started (e.g. its executable is missing)
+    """
+    stages = []
+    
+    try:
+        with ExitStack() as stack:
+            out = stack.enter_context(open(output_path, "wb"))
+            stdin = None
+            for i, argv in enumerate(commands):
+                is_last = i == len(commands) - 1
+                # stderr goes to a temporary file so a chatty stage can't block on a full pipe
+                stderr = stack.enter_context(tempfile.TemporaryFile())
+                try:
+                    process = subprocess.Popen(
+                        argv,
+                        stdin=stdin,
+                        stdout=out if is_last and not gzip_output else subprocess.PIPE,
+                        stderr=stderr
+                    )
+                finally:
+                    # Close our copy of the upstream pipe, so EOF/SIGPIPE propagate between stages
+                    if stdin is not None:
+                        stdin.close()
+                stdin = process.stdout
+                stages.append((argv, process, stderr))
+            
+            if gzip_output:
+                # Compression here overlaps with the pipeline running in the child processes
+                with stdin as src, gzip.open(out, "wb") as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            
+            for _, process, _ in stages:
+                process.wait()
+            
+            _check_pipeline(stages)
+    
+    except BaseException:
+        # Don't leave stages running or a partial output file behind
+        for _, process, _ in stages:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        Path(output_path).unlink(missing_ok=True)
+        raise
+
+
+def _check_pipeline(stages: List[Tuple[List[str], subprocess.Popen, IO[bytes]]]) -> None:
+    """
+    Raise an informative error if any process in a completed pipeline failed.
+    
+    Args:
+        stages: Command line, completed process and stderr file for each stage, in pipeline order
+        
+    Raises:
+        RuntimeError: If any process exited with a non-zero status
+    """
+    messages = []
+    for _, _, stderr in stages:
+        stderr.seek(0)
+        messages.append(stderr.read().decode().strip())
+    
+    failed = [i for i, (_, process, _) in enumerate(stages) if process.returncode != 0]
+    if not failed:
+        return
+    
+    # Upstream stages killed by SIGPIPE are a symptom of a downstream failure, so report the latter
+    root_causes = [i for i in failed if stages[i][1].returncode != -signal.SIGPIPE]
+    i = (root_causes or failed)[0]
+    argv, process, _ = stages[i]
+    
+    raise RuntimeError(f"{argv[0]} failed with exit code {process.returncode}: {messages[i]}")
+
+
+def _run_genomecov(
+    bam_path: str,
+    options: List[str],
+    output_path: str,
+    compress: bool = False,
+    bam_threads: int = 0,
+    regions: Optional[List[str]] = None
+) -> None:
+    """
+    Run bedtools genomecov, redirecting its output straight to the final output file.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        options: Command line options for bedtools genomecov (see _genomecov_options)
+        output_path: Path to write coverage output to
+        compress: gzip compress output on the fly (with bgzip/pigz if available)
+        bam_threads: Decompress the BAM with this many threads using samtools (if available),
+                     streaming uncompressed BAM to bedtools. 0 to let bedtools read the BAM directly
+        regions: Only pass reads from these contigs to bedtools. Only used when reads are piped through
+                 samtools (bam_threads > 0 and samtools available). Contigs must be in reference order
+                 (the BAM header is unchanged, so -bga output is unaffected)
+        
+    Raises:
+        RuntimeError: If any command in the pipeline exits with a non-zero status
+    """
+    commands = []
+    
+    # bedtools decompresses BAM single-threaded, so offload this to samtools where possible
+    if bam_threads > 0 and shutil.which("samtools"):
+        commands.append(_samtools_view_argv(bam_path, bam_threads, regions))
+        bam_path = "stdin"
+    
+    commands.append(_genomecov_argv(bam_path, options))
+    
+    gzip_output = False
+    if compress:
+        compressor = _compressor_argv()
+        if compressor is None:
+            gzip_output = True
+        else:
+            commands.append(compressor)
+    
+    _run_pipeline(commands, output_path, gzip_output=gzip_output)
+
+
+def _open_bam(bam_path: str, threads: int = 0) -> pysam.AlignmentFile:
+    """
+    Open a BAM file for reading.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        threads: Number of additional threads htslib uses to decompress the BAM
+        
+    Returns:
+        The opened BAM file
+        
+    Raises:
+        FileNotFoundError: If the BAM file does not exist
+    """
+    try:
+        return pysam.AlignmentFile(bam_path, "rb", threads=threads)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(f"Input BAM file not found: {bam_path}") from e
+
+
+def _index_mapped_reads(bam_path: str) -> Optional[Dict[str, int]]:
+    """
+    Get the number of mapped reads on each contig from the BAM index (as with samtools idxstats).
+    
+    Args:
+        bam_path: Path to the input BAM file
+        
+    Returns:
+        Dictionary mapping contigs (in reference order) to their number of mapped reads,
+        or None if the BAM file is not indexed
+    """
+    with _open_bam(bam_path) as bam:
+        if not bam.has_index():
+            return None
+        return {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+
+
+class _BGZFWriter(pysam.BGZFile):
+    """BGZF output file that (like other binary files) accepts any bytes-like object, not just bytes."""
+    
+    def write(self, data) -> int:
+        return super().write(bytes(data))
+
+
+@contextmanager
+def _open_output(output_path: str, compress: bool = False) -> Iterator[IO[bytes]]:
+    """
+    Open an output file for writing in binary mode.
+    
+    Compressed output is piped through bgzip/pigz if available (see _compressor_argv), so compression runs
+    with multiple threads in a separate process, overlapping with computing coverage. Otherwise it is written
+    with htslib's BGZF implementation (as used by bgzip) in this process. Either way, output is gzip compatible.
+    
+    Args:
+        output_path: Path to the output file
+        compress: Compress the output
+        
+    Yields:
+        The opened output file
+        
+    Raises:
+        RuntimeError: If the compressor exits with a non-zero status
+    """
+    compressor = _compressor_argv() if compress else None
+    
+    if compressor is None:
+        with _BGZFWriter(output_path, "wb") if compress else open(output_path, "wb", buffering=COPY_BUFSIZE) as out:
+            yield out
+        return
+    
+    with open(output_path, "wb") as out, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            compressor, stdin=subprocess.PIPE, stdout=out, stderr=stderr, bufsize=COPY_BUFSIZE
+        )
+        broken_pipe = False
+        try:
+            yield process.stdin
+            process.stdin.close()
+        except BrokenPipeError:
+            # The compressor exited early, which is reported below
+            broken_pipe = True
+        finally:
+            # Closing stdin lets the compressor finish, so it exits even if writing output failed
+            with suppress(BrokenPipeError):
+                process.stdin.close()
+            process.wait()
+        
+        _check_pipeline([(compressor, process, stderr)])
+        if broken_pipe:
+            raise RuntimeError(f"{compressor[0]} exited before all output was written")
+
+
+def _check_bedgraph_options(bg: bool, bga: bool, five_prime: bool, three_prime: bool) -> None:
+    """
+    Check that bedgraph output options are compatible.
+    
+    Raises:
+        ValueError: If both/neither of bg and bga are True, or if both five_prime and three_prime are True
+    """
+    if bg and bga:
+        raise ValueError("bg and bga are mutually exclusive")
+    
+    if not bg and not bga:
+        raise ValueError("Either bg or bga must be True to generate a bedgraph file")
+    
+    # Check for mutually exclusive 5'/3' options
+    if five_prime and three_prime:
+        raise ValueError("Cannot specify both five_prime and three_prime")
+
+
+def _bedgraph_track_line(trackline: bool, trackopts: Optional[str]) -> str:
+    """
+    Get the UCSC track line header for a bedgraph file, as written by bedtools genomecov.
+    
+    Args:
+        trackline: Add UCSC track line definition
+        trackopts: Additional track line parameters (implies trackline)
+        
+    Returns:
+        The track line (including trailing newline), or an empty string if no track line is requested
+    """
+    if not trackline and not trackopts:
+        return ""
+    if trackopts:
+        return f"track type=bedGraph {trackopts}\n"
+    return "track type=bedGraph\n"
+
+
+def _read_strand(read: pysam.AlignedSegment, du: bool) -> str:
+    """
+    Get the strand a read contributes coverage to, as with bedtools genomecov -strand.
+    
+    Args:
+        read: An aligned read
+        du: Change strand of the mate read (so both reads from same strand)
+        
+    Returns:
+        '+' or '-'
+    """
+    is_reverse = read.is_reverse
+    
+    # flip the second mate so both mates of a pair contribute to the same strand
+    if du and read.is_paired and read.is_read2:
+        is_reverse = not is_reverse
+    
+    return "-" if is_reverse else "+"
+
+
+def _read_blocks(
+    read: pysam.AlignedSegment,
+    split: bool,
+    ignoreD: bool,
+    five_prime: bool,
+    three_prime: bool
+) -> List[Tuple[int, int]]:
+    """
+    Get the reference intervals a read contributes coverage to, as with bedtools genomecov.
+    
+    Deletions always split a read into separate blocks (unless ignoreD), skipped regions (i.e. introns)
+    only if split is True.
+    
+    Args:
+        read: An aligned read
+        split: Treat "split" BAM entries as distinct intervals when computing coverage
+        ignoreD: Ignore local deletions (CIGAR "D" operations) in BAM entries
+        five_prime: Only the 5' position of the read
+        three_prime: Only the 3' position of the read
+        
+    Returns:
+        List of 0-based, half-open (start, end) intervals
+    """
+    if five_prime or three_prime:
+        # 5'/3' ends are based on the aligned strand of the read itself (i.e. regardless of du)
+        if five_prime != read.is_reverse:
+            pos = read.reference_start
+        else:
+            pos = read.reference_end - 1
+        return [(pos, pos + 1)]
+    
+    blocks = []
+    block_start = pos = read.reference_start
+    for op, length in read.cigartuples:
+        if op in _CIGAR_ALIGNED or (op == pysam.CDEL and ignoreD) or (op == pysam.CREF_SKIP and not split):
+            pos += length
+        elif op == pysam.CDEL or op == pysam.CREF_SKIP:
+            if pos > block_start:
+                blocks.append((block_start, pos))
+            pos += length
+            block_start = pos
+    
+    if pos > block_start:
+        blocks.append((block_start, pos))
+    
+    return blocks
+
+
+def _write_bedgraph_records(
+    out: IO[bytes],
+    chrom: str,
+    starts: List[int],
+    ends: List[int],
+    length: int,
+    bga: bool,
+    scale: float
+) -> None:
+    """
+    Compute per-base coverage of a contig from covered intervals, writing it as bedgraph records.
+    
+    Args:
+        out: Output file to write records to
+        chrom: Name of the contig
+        starts: 0-based start positions of the covered intervals
+        ends: 0-based, exclusive end positions of the covered intervals
+        length: Length of the contig
+        bga: Include regions with zero coverage
+        scale: Scale coverage by a constant factor
+    """
+    # Explicit dtype, as intervals are empty if no reads on the strand have aligned bases (e.g. CIGAR '30S')
+    delta = difference_array(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), length)
+    run_starts, run_ends, depths = coverage_runs(delta, bga, max_runs=2 * len(starts) + 1)
+    write_bedgraph(out, chrom, run_starts, run_ends, depths, scale)
+
+
+def _contig_intervals(
+    reads: Iterable[pysam.AlignedSegment],
+    strands: Iterable[str],
+    split: bool,
+    du: bool,
+    ignoreD: bool,
+    five_prime: bool,
+    three_prime: bool
+) -> Dict[str, Tuple[List[int], List[int]]]:
+    """
+    Collect the intervals covered by reads aligned to a single contig, for each strand.
+    
+    Args:
+        reads: Reads aligned to the contig
+        strands: Strands ('+'/'-') to collect intervals for
+        split, du, ignoreD, five_prime, three_prime: See get_stranded_bedgraph
+        
+    Returns:
+        Dictionary mapping strands with at least one mapped read to lists of interval start and end positions
+    """
+    intervals = {}
+    for read in reads:
+        # Mapped reads without a CIGAR ('*') have no aligned bases
+        if read.is_unmapped or read.cigartuples is None:
+            continue
+        
+        strand = _read_strand(read, du)
+        if strand not in strands:
+            continue
+        
+        starts, ends = intervals.setdefault(strand, ([], []))
+        for start, end in _read_blocks(read, split, ignoreD, five_prime, three_prime):
+            starts.append(start)
+            ends.append(end)
+    
+    return intervals
+
+
+def _empty_contig_records(references: Iterable[str], lengths: Iterable[int], visited: Set[str]) -> bytes:
+    """
+    Get zero coverage bedgraph records for contigs without reads, as reported by bedtools genomecov -bga.
+    
+    Args:
+        references: Names of all contigs in the BAM file
+        lengths: Lengths of all contigs in the BAM file
+        visited: Names of contigs with reads
+        
+    Returns:
+        Bedgraph records for contigs not in visited
+    """
+    return "".join(
+        f"{chrom}\t0\t{length}\t0\n"
+        for chrom, length in zip(references, lengths)
+        if chrom not in visited
+    ).encode()
+
+
+def _write_bedgraphs(
+    bam: pysam.AlignmentFile,
+    outputs: Dict[str, IO[bytes]],
+    split: bool,
+    du: bool,
+    ignoreD: bool,
+    scale: float,
+    bga: bool,
+    five_prime: bool,
+    three_prime: bool
+) -> None:
+    """
+    Write per-strand bedgraph coverage with a single pass over a coordinate-sorted BAM file.
+    
+    Output matches bedtools genomecov - contigs are reported in the order they are encountered,
+    followed (with bga) by contigs without any reads on that strand.
+    
+    Args:
+        bam: The input BAM file
+        outputs: Dictionary mapping strands ('+'/'-') to their output files
+        split, du, ignoreD, scale, bga, five_prime, three_prime: See get_stranded_bedgraph
+    """
+    visited = {strand: set() for strand in outputs}
+    
+    for contig_id, reads in groupby(bam.fetch(until_eof=True), key=attrgetter("reference_id")):
+        # unplaced unmapped reads
+        if contig_id < 0:
+            continue
+        
+        chrom = bam.get_reference_name(contig_id)
+        intervals = _contig_intervals(reads, outputs, split, du, ignoreD, five_prime, three_prime)
+        for strand, (starts, ends) in intervals.items():
+            _write_bedgraph_records(outputs[strand], chrom, starts, ends, bam.lengths[contig_id], bga, scale)
+            visited[strand].add(chrom)
+    
+    if bga:
+        for strand, out in outputs.items():
+            out.write(_empty_contig_records(bam.references, bam.lengths, visited[strand]))
+
+
+def _contig_batches(mapped_reads: Dict[str, int], threads: int) -> List[List[str]]:
+    """
+    Group contigs with mapped reads into batches with similar numbers of reads, to process in parallel.
+    
+    Args:
+        mapped_reads: Dictionary mapping contigs (in reference order) to their number of mapped reads
+        threads: Number of worker processes
+        
+    Returns:
+        Batches of contig names, in reference order. Empty if there are too few reads to be worth processing in parallel
+    """
+    total = sum(mapped_reads.values())
+    if total < PARALLEL_MIN_READS:
+        return []
+    
+    target = total / (threads * _BATCHES_PER_WORKER)
+    batches = []
+    batch = []
+    batch_reads = 0
+    for contig, mapped in mapped_reads.items():
+        if mapped == 0:
+            continue
+        
+        batch.append(contig)
+        batch_reads += mapped
+        if batch_reads >= target:
+            batches.append(batch)
+            batch = []
+            batch_reads = 0
+    
+    if batch:
+        batches.append(batch)
+    
+    return batches
+
+
+def _init_worker(bam_path: str) -> None:
+    """Open the BAM file once in each worker process, rather than for every batch of contigs."""
+    global _worker_bam
+    _worker_bam = _open_bam(bam_path, threads=_WORKER_BAM_THREADS)
+
+
+def _batch_coverage(
+    contigs: List[str],
+    strands: Tuple[str, ...],
+    shard_prefix: str,
+    split: bool,
+    du: bool,
+    ignoreD: bool,
+    scale: float,
+    bga: bool,
+    five_prime: bool,
+    three_prime: bool
+) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    """
+    Write bedgraph coverage of a batch of contigs to a shard file for each strand (run in a worker process).
+    
+    Args:
+        contigs: Names of the contigs, in reference order
+        strands: Strands ('+'/'-') to compute coverage for
+        shard_prefix: Prefix for shard files (<shard_prefix>.<plus|minus>.bg)
+        split, du, ignoreD, scale, bga, five_prime, three_prime: See get_stranded_bedgraph
+        
+    Returns:
+        Dictionary mapping strands to their shard file paths, and dictionary mapping strands to the contigs with reads
+    """
+    shards = {strand: f"{shard_prefix}.{'plus' if strand == '+' else 'minus'}.bg" for strand in strands}
+    visited = {strand: [] for strand in strands}
+    
+    with ExitStack() as stack:
+        outputs = {strand: stack.enter_context(open(shard, "wb")) for strand, shard in shards.items()}
+        for contig in contigs:
+            length = _worker_bam.get_reference_length(contig)
+            intervals = _contig_intervals(
+                _worker_bam.fetch(contig), strands, split, du, ignoreD, five_prime, three_prime
+            )
+            for strand, (starts, ends) in intervals.items():
+                _write_bedgraph_records(outputs[strand], contig, starts, ends, length, bga, scale)
+                visited[strand].append(contig)
+    
+    return shards, visited
+
+
+def _write_bedgraphs_parallel(
+    bam: pysam.AlignmentFile,
+    outputs: Dict[str, IO[bytes]],
+    batches: List[List[str]],
+    threads: int,
+    tmpdir: str,
+    **kwargs
+) -> None:
+    """
+    Write per-strand bedgraph coverage of an indexed BAM file, computing coverage of batches of contigs in parallel.
+    
+    Each batch is processed by a worker process, writing to a shard file per strand. Shards are then
+    concatenated in reference order, so output is identical to _write_bedgraphs.
+    
+    Args:
+        bam: The input BAM file (must have an index)
+        outputs: Dictionary mapping strands ('+'/'-') to their output files
+        batches: Batches of contigs with mapped reads, in reference order (see _contig_batches)
+        threads: Number of worker processes
+        tmpdir: Directory to write shard files to
+        **kwargs: Coverage options to pass to _batch_coverage (see get_stranded_bedgraph)
+    """
+    strands = tuple(outputs)
+    
+    with ProcessPoolExecutor(
+        max_workers=min(threads, len(batches)),
+        initializer=_init_worker,
+        initargs=(bam.filename.decode(),)
+    ) as executor:
+        futures = [
+            executor.submit(_batch_coverage, batch, strands, os.path.join(tmpdir, f"{idx:05d}"), **kwargs)
+            for idx, batch in enumerate(batches)
+        ]
+        # Collect in reference order (i.e. the order contigs are encountered in a coordinate-sorted BAM)
+        results = [future.result() for future in futures]
+    
+    for strand, out in outputs.items():
+        visited = set()
+        for shards, batch_visited in results:
+            with open(shards[strand], "rb") as shard:
+                shutil.copyfileobj(shard, out, COPY_BUFSIZE)
+            visited.update(batch_visited[strand])
+        
+        if kwargs["bga"]:
+            out.write(_empty_contig_records(bam.references, bam.lengths, visited))
+
+
+def _mosdepth_bedgraphs(
+    bam_path: str,
+    output_paths: Dict[str, str],
+    split: bool,
+    du: bool,
+    ignoreD: bool,
+    scale: float,
+    bga: bool,
+    five_prime: bool,
+    three_prime: bool,
+    trackline: bool,
+    trackopts: Optional[str],
+    compress: bool,
+    bam_threads: int,
+    threads: int = THREADS
+) -> None:
+    """
+    Write bedgraph coverage for one or more strands in-process, with a single pass over the BAM file.
+    
+    If the BAM file is indexed, threads > 1 and there are enough mapped reads, contigs are processed in parallel.
+    
+    Args:
+        bam_path: Path to the input (coordinate-sorted) BAM file
+        output_paths: Dictionary mapping strands ('+'/'-') to their output file paths
+        bam_threads: Number of additional threads used to decompress the BAM
+        threads: Number of processes used to compute coverage of contigs in parallel
+        (all other arguments): See get_stranded_bedgraph
+    """
+    track_line = _bedgraph_track_line(trackline, trackopts).encode()
+    coverage_kwargs = dict(
+        split=split,
+        du=du,
+        ignoreD=ignoreD,
+        scale=scale,
+        bga=bga,
+        five_prime=five_prime,
+        three_prime=three_prime
+    )
+    
+    mapped_reads = _index_mapped_reads(bam_path) if threads > 1 else None
+    batches = _contig_batches(mapped_reads, threads) if mapped_reads else []
+    parallel = len(batches) > 1
+    
+    try:
+        with ExitStack() as stack:
+            # Workers read the BAM themselves, and forking with htslib threads running can deadlock
+            bam = stack.enter_context(_open_bam(bam_path, threads=0 if parallel else bam_threads))
+            outputs = {
+                strand: stack.enter_context(_open_output(path, compress))
+                for strand, path in output_paths.items()
+            }
+            
+            for out in outputs.values():
+                out.write(track_line)
+            
+            if parallel:
+                # Shards are written next to the output, rather than a (potentially small) system temporary directory
+                output_dir = os.path.dirname(next(iter(output_paths.values()))) or "."
+                tmpdir = stack.enter_context(tempfile.TemporaryDirectory(prefix=".rnabam2cov.", dir=output_dir))
+                _write_bedgraphs_parallel(bam, outputs, batches, threads, tmpdir, **coverage_kwargs)
+            else:
+                _write_bedgraphs(bam, outputs, **coverage_kwargs)
+    
+    except BaseException:
+        # Don't leave truncated output files behind
+        for path in output_paths.values():
+            Path(path).unlink(missing_ok=True)
+        raise
+
+
+def _write_empty_bedgraph(
+    bam_path: str,
+    output_path: str,
+    bga: bool,
+    trackline: bool,
+    trackopts: Optional[str],
+    compress: bool
+) -> None:
+    """
+    Write a bedgraph file for a BAM file without mapped reads, as reported by bedtools genomecov.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        output_path: Path to the output file
+        bga, trackline, trackopts, compress: See get_stranded_bedgraph
+    """
+    with _open_bam(bam_path) as bam, _open_output(output_path, compress) as out:
+        out.write(_bedgraph_track_line(trackline, trackopts).encode())
+        if bga:
+            out.write(_empty_contig_records(bam.references, bam.lengths, set()))
+
+
+def _mosdepth_bedgraph(bam_path: str, strand: str, output_path: str, **kwargs) -> None:
+    """
+    Write a strand-specific bedgraph coverage file in-process.
+    
+    Args:
+        bam_path: Path to the input (coordinate-sorted) BAM file
+        strand: Strand to extract ('+' or '-')
+        output_path: Path to the output file
+        **kwargs: Additional arguments to pass to _mosdepth_bedgraphs
+    """
+    _mosdepth_bedgraphs(bam_path, {strand: output_path}, **kwargs)
+
+
 def get_stranded_bedgraph(
-    bam_path: Union[str, Path],
+    bam_path: Union[str, os.PathLike],
     strand: str,
     output_prefix: str,
     split: bool = True,
@@ -44,11 +890,20 @@ def get_stranded_bedgraph(
     five_prime: bool = False,
     three_prime: bool = False,
     trackline: bool = False,
-    trackopts: Optional[str] = None
+    trackopts: Optional[str] = None,
+    use_subprocess: bool = True,
+    compress: bool = False,
+    bam_threads: int = BAM_THREADS,
+    use_bedtools: bool = True,
+    threads: int = THREADS
 ) -> str:
     """
     Generate a strand-specific bedgraph coverage file from a BAM file.
     
+    Coverage is computed with bedtools genomecov by default. With use_bedtools=False, coverage of
+    coordinate-sorted BAM files is instead computed in-process (matching bedtools genomecov output),
+    unless paired-end fragment options (pc, fs) are requested.
+    
     Args:
         bam_path: Path to the input BAM file
         strand: Strand to extract ('+' or '-')
@@ -61,11 +916,21 @@ def get_stranded_bedgraph(
         scale: Scale coverage by a constant factor
         bg: Report coverage in bedgraph format
         bga: Report coverage in bedgraph format, including regions with zero coverage
-        max_depth: Combine all positions with depth >= max_depth
+        max_depth: Combine all positions with depth >= max_depth. Has no effect, as bedtools genomecov
+                   ignores this for bedgraph output (kept for compatibility)
         five_prime: Calculate coverage of 5' positions only
         three_prime: Calculate coverage of 3' positions only
         trackline: Add UCSC track line definition
         trackopts: Additional track line parameters
+        use_subprocess: Call bedtools genomecov directly and stream output to the final file,
+                        rather than via pybedtools (which writes to a temporary file that is then copied)
+        compress: gzip compress the output on the fly (with bgzip/pigz if available), writing a .bedgraph.gz file
+        bam_threads: Number of threads used to decompress the BAM. With bedtools, samtools decompresses the BAM
+                     before streaming to bedtools (only with use_subprocess, and if samtools is available). 0 to disable
+        use_bedtools: Compute coverage with bedtools genomecov. False to compute coverage in-process
+                      (experimental, until validated against bedtools across all options)
+        threads: Number of processes used to compute coverage of contigs in parallel (in-process only,
+                 requires an indexed BAM with at least PARALLEL_MIN_READS mapped reads). 1 to disable
         
     Returns:
         Path to the generated bedgraph file
@@ -73,69 +938,89 @@ def get_stranded_bedgraph(
     Raises:
         ValueError: If both bg and bga are True, if strand is not '+' or '-',
                    or if incompatible options are selected
+        FileNotFoundError: If the BAM file does not exist
     """
     if strand not in ['+', '-']:
         raise ValueError(f"Strand must be '+' or '-', got '{strand}'")
     
-    if bg and bga:
-        raise ValueError("bg and bga are mutually exclusive")
-    
-    if not bg and not bga:
-        raise ValueError("Either bg or bga must be True to generate a bedgraph file")
-    
-    # Check for mutually exclusive 5'/3' options
-    if five_prime and three_prime:
-        raise ValueError("Cannot specify both five_prime and three_prime")
+    _check_bedgraph_options(bg, bga, five_prime, three_prime)
     
-    # Initialize bedtools object with the BAM file
-    bt = pybedtools.BedTool(str(bam_path))
+    # Convert once, rather than for each tool the path is passed to
+    bam_path = os.fspath(bam_path)
     
-    # Build the arguments for genome_coverage
-    kwargs = {
-        'strand': strand,
-    }
+    # Define output file path
+    output_path = f"{output_prefix}.{get_file_extension(FileType.BEDGRAPH)}"
+    if compress:
+        output_path += ".gz"
     
-    # Add optional arguments if they are set
-    if split:
-        kwargs['split'] = True
-    if pc:
-        kwargs['pc'] = True
-    if fs:
-        kwargs['fs'] = True
-    if du:
-        kwargs['du'] = True
-    if ignoreD:
-        kwargs['ignoreD'] = True
-    if scale != 1.0:
-        kwargs['scale'] = scale
-    if bg:
-        kwargs['bg'] = True
-    if bga:
-        kwargs['bga'] = True
-    if max_depth:
-        kwargs['max'] = max_depth
-    if five_prime:
-        kwargs['5'] = True
-    if three_prime:
-        kwargs['3'] = True
-    if trackline:
-        kwargs['trackline'] = True
-    if trackopts:
-        kwargs['trackopts'] = trackopts
+    # Paired-end fragment options are only supported by bedtools
+    if not (use_bedtools or pc or fs):
+        _mosdepth_bedgraph(
+            bam_path,
+            strand,
+            output_path,
+            split=split,
+            du=du,
+            ignoreD=ignoreD,
+            scale=scale,
+            bga=bga,
+            five_prime=five_prime,
+            three_prime=three_prime,
+            trackline=trackline,
+            trackopts=trackopts,
+            compress=compress,
+            bam_threads=bam_threads,
+            threads=threads
+        )
+        return output_path
     
-    # Generate the coverage file
-    result = bt.genome_coverage(**kwargs)
+    # With an indexed BAM, skip running bedtools if there are no mapped reads, or the contigs without any
+    mapped_reads = _index_mapped_reads(bam_path)
+    if mapped_reads is not None and not any(mapped_reads.values()):
+        _write_empty_bedgraph(bam_path, output_path, bga, trackline, trackopts, compress)
+        return output_path
     
-    # Define output file path
-    output_path = f"{output_prefix}.{get_file_extension(FileType.BEDGRAPH)}"
+    # Restricting to contigs with reads needs samtools, so only do so if it's decompressing the BAM anyway
+    regions = None
+    if bam_threads > 0 and mapped_reads is not None and not all(mapped_reads.values()):
+        regions = [contig for contig, mapped in mapped_reads.items() if mapped > 0]
     
-    # Save to file
-    result.saveas(output_path)
+    if use_subprocess:
+        # Generate the coverage file directly at the output path
+        _run_genomecov(
+            bam_path,
+            _genomecov_options(strand, locals()),
+            output_path,
+            compress=compress,
+            bam_threads=bam_threads,
+            regions=regions
+        )
+    else:
+        # Build the arguments for genome_coverage from the options that are set
+        options = locals()
+        kwargs = {'strand': strand}
+        kwargs.update((key, True) for arg, key in _FLAG_MAP if options[arg])
+        kwargs.update((key, options[arg]) for arg, key in _VAL_MAP if options[arg])
+        if scale != 1.0:
+            kwargs['scale'] = scale
+        
+        # Initialize bedtools object with the BAM file
+        bt = pybedtools.BedTool(bam_path)
+        
+        # Generate the coverage file
+        result = bt.genome_coverage(**kwargs)
+        
+        # Save to file
+        if compress:
+            with open(result.fn, "rb") as src, gzip.open(output_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+        else:
+            _copy_file(result.fn, output_path)
     
     return output_path
 
 def get_stranded_coverage(
-    bam_path: Union[str, Path],
+    bam_path: Union[str, os.PathLike],
     strand: str,
     output_prefix: str,
     file_type: FileType = FileType.BEDGRAPH,
@@ -164,4 +1049,83 @@ def get_stranded_coverage(
     if file_type == FileType.BEDGRAPH:
         return get_stranded_bedgraph(bam_path, strand, output_prefix, **kwargs)
     else:
-        raise ValueError(f"Unsupported file type: {file_type}")
\ No newline at end of file
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def get_stranded_coverage_both_strands(
+    bam_path: Union[str, os.PathLike],
+    output_prefix_plus: str,
+    output_prefix_minus: str,
+    libtype: Union[str, LibraryType],
+    file_type: FileType = FileType.BEDGRAPH,
+    split: bool = True,
+    du: bool = True,
+    ignoreD: bool = False,
+    scale: float = 1.0,
+    bg: bool = True,
+    bga: bool = False,
+    max_depth: Optional[int] = None,
+    five_prime: bool = False,
+    three_prime: bool = False,
+    trackline: bool = False,
+    trackopts: Optional[str] = None,
+    compress: bool = False,
+    bam_threads: int = BAM_THREADS,
+    threads: int = THREADS
+) -> Dict[str, str]:
+    """
+    Generate coverage files for both strands with a single pass over a coordinate-sorted BAM file.
+    
+    Coverage is computed in-process (rather than with bedtools), reading the BAM once for both strands
+    instead of once per strand. Output matches bedtools genomecov, except that paired-end fragment
+    coverage (pc) and fragment size (fs) options are not supported.
+    
+    Args:
+        bam_path: Path to the input BAM file
+        output_prefix_plus: Output file prefix for the transcribed plus strand
+        output_prefix_minus: Output file prefix for the transcribed minus strand
+        libtype: Library type, either 'forward' or 'reverse' (or the corresponding LibraryType)
+        file_type: Type of output file
+        bam_threads: Number of additional threads used to decompress the BAM
+        threads: Number of processes used to compute coverage of contigs in parallel (requires an indexed BAM
+                 with at least PARALLEL_MIN_READS mapped reads)
+        max_depth: Has no effect (see get_stranded_bedgraph)
+        (all other arguments): See get_stranded_bedgraph
+        
+    Returns:
+        Dictionary mapping genomic strands ('+', '-') to paths of the generated coverage files
+        
+    Raises:
+        ValueError: If an unsupported file type or incompatible options are provided
+    """
+    if file_type != FileType.BEDGRAPH:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    
+    _check_bedgraph_options(bg, bga, five_prime, three_prime)
+    
+    # Assign each genomic strand to its transcribed strand's output
+    transcribed_prefixes = {"+": output_prefix_plus, "-": output_prefix_minus}
+    extension = get_file_extension(file_type) + (".gz" if compress else "")
+    output_paths = {
+        strand: f"{transcribed_prefixes[transcribed]}.{extension}"
+        for strand, transcribed in get_strand_mapping(libtype).items()
+    }
+    
+    _mosdepth_bedgraphs(
+        os.fspath(bam_path),
+        output_paths,
+        split=split,
+        du=du,
+        ignoreD=ignoreD,
+        scale=scale,
+        bga=bga,
+        five_prime=five_prime,
+        three_prime=three_prime,
+        trackline=trackline,
+        trackopts=trackopts,
+        compress=compress,
+        bam_threads=bam_threads,
+        threads=threads
+    )
+    
+    return output_paths
@@ -2,7 +2,9 @@
 Helpers to map aligned strands to transcribed strands based on the input RNA-seq library type
 """
 from enum import Enum
-from typing import Dict
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Mapping, Union
 
 
 class LibraryType(Enum):
@@ -11,12 +13,26 @@ class LibraryType(Enum):
     REVERSE = "reverse"  # RF/fr-firststrand (dUTP)
 
 
-def get_strand_mapping(lib_type: str) -> Dict[str, str]:
+# Mapping of genomic strands to transcribed strands for each library type
+_STRAND_MAPPINGS = MappingProxyType({
+    # FR/fr-secondstrand: first read maps to transcription strand
+    LibraryType.FORWARD.value: MappingProxyType({"+": "+", "-": "-"}),
+    # RF/fr-firststrand: first read maps to opposite of transcription strand
+    LibraryType.REVERSE.value: MappingProxyType({"+": "-", "-": "+"}),
+})
+
+# Output file suffixes of transcribed strands
+_OUTPUT_SUFFIXES = MappingProxyType({"+": "plus", "-": "minus"})
+
+
+def get_strand_mapping(lib_type: Union[str, LibraryType]) -> Mapping[str, str]:
     """
     Get mapping between genomic strands and transcribed strands based on library type.
     
+    The returned mapping is shared between calls, so is read-only.
+    
     Args:
-        lib_type: Library type, either 'forward' or 'reverse'
+        lib_type: Library type, either 'forward' or 'reverse' (or the corresponding LibraryType)
         
     Returns:
         Dictionary mapping genomic strands ('+', '-') to transcribed strands
@@ -24,42 +40,33 @@ def get_strand_mapping(lib_type: str) -> Dict[str, str]:
     Raises:
         ValueError: If an unknown library type is provided
     """
-    lib_type = LibraryType(lib_type.lower())
+    key = lib_type.value if isinstance(lib_type, LibraryType) else lib_type.lower()
     
-    if lib_type == LibraryType.FORWARD:
-        # FR/fr-secondstrand: first read maps to transcription strand
-        return {"+": "+", "-": "-"}
-    elif lib_type == LibraryType.REVERSE:
-        # RF/fr-firststrand: first read maps to opposite of transcription strand
-        return {"+": "-", "-": "+"}
-    else:
-        raise ValueError(f"Unknown library type: {lib_type}")
+    try:
+        return _STRAND_MAPPINGS[key]
+    except KeyError:
+        raise ValueError(f"Unknown library type: {lib_type}") from None
 
 
-def get_output_prefixes(base_prefix: str, lib_type: str) -> Dict[str, str]:
+@lru_cache(maxsize=32)
+def get_output_prefixes(base_prefix: str, lib_type: Union[str, LibraryType]) -> Mapping[str, str]:
     """
     Generate output file prefixes for each strand based on library type.
     
+    Results are cached, so the returned mapping is read-only.
+    
     Maps the alignment strands to output file prefixes using strand mapping.
     - The "+" alignment strand maps to "forward" or "reverse" based on library type
     - The "-" alignment strand maps to "reverse" or "forward" based on library type
     
     Args:
         base_prefix: Base output prefix
-        lib_type: Library type, either 'forward' or 'reverse'
+        lib_type: Library type, either 'forward' or 'reverse' (or the corresponding LibraryType)
         
     Returns:
         Dictionary mapping genomic strands to output prefixes
     """
-    # Get the mapping of genomic strands to transcribed strands
-    strand_mapping = get_strand_mapping(lib_type)
-    
-    # Map the genomic strands to output prefixes based on transcribed strands
-    output_prefixes = {}
-    for genomic_strand, transcribed_strand in strand_mapping.items():
-        if transcribed_strand == "+":
-            output_prefixes[genomic_strand] = f"{base_prefix}.plus"
-        else:  # transcribed_strand == "-"
-            output_prefixes[genomic_strand] = f"{base_prefix}.minus"
-    
-    return output_prefixes
+    return MappingProxyType({
+        genomic_strand: f"{base_prefix}.{_OUTPUT_SUFFIXES[transcribed_strand]}"
+        for genomic_strand, transcribed_strand in get_strand_mapping(lib_type).items()
+    })
@@ -0,0 +1,204 @@
+"""
+Helpers for computing per-base coverage from difference arrays (as in mosdepth).
+
+The inner loops are JIT-compiled with numba if it is installed, otherwise equivalent vectorised NumPy code is used.
+Compiled functions are cached on disk, so they are only compiled once rather than in every process.
+"""
+from typing import IO, Tuple
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is an optional dependency
+    njit = None
+
+HAVE_NUMBA = njit is not None
+
+# Depths are formatted as with bedtools (a C++ stream of a double, i.e. '%g'), which only matches
+# plain integer formatting below 1e6
+_MAX_INTEGER_DEPTH = 10**6
+
+# Maximum number of digits in a formatted start/end position or depth (int64)
+_MAX_DIGITS = 19
+
+# Maximum size of each chunk of bedgraph records formatted before writing, bounding memory use on deeply covered contigs
+_FORMAT_BUFSIZE = 16 << 20
+
+
+def difference_array(starts: np.ndarray, ends: np.ndarray, length: int) -> np.ndarray:
+    """
+    Build a coverage difference array for a contig from covered intervals.
+
+    Each interval adds +1 at its start and -1 at its end, so the cumulative sum gives per-base coverage.
+    Coverage can be no greater than the number of intervals, so int16 is used when this can't overflow
+    (halving memory use and bandwidth of the coverage loops), otherwise int32.
+
+    Args:
+        starts: 0-based start positions of the intervals
+        ends: 0-based, exclusive end positions of the intervals
+        length: Length of the contig (intervals are truncated at the contig end)
+
+    Returns:
+        Difference array of size length + 1
+    """
+    dtype = np.int16 if len(starts) <= np.iinfo(np.int16).max else np.int32
+    delta = np.zeros(length + 1, dtype=dtype)
+    np.add.at(delta, np.minimum(starts, length), 1)
+    np.subtract.at(delta, np.minimum(ends, length), 1)
+    return delta
+
+
+def _coverage_runs_numpy(
+    delta: np.ndarray,
+    bga: bool,
+    max_runs: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """NumPy implementation of coverage_runs."""
+    coverage = np.cumsum(delta[:-1], dtype=delta.dtype)
+
+    # Collapse into runs of constant coverage
+    boundaries = np.flatnonzero(coverage[1:] != coverage[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [coverage.size]))
+    depths = coverage[starts]
+
+    if not bga:
+        nonzero = depths > 0
+        starts, ends, depths = starts[nonzero], ends[nonzero], depths[nonzero]
+
+    return starts, ends, depths
+
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _emit_runs(delta, bga, runs):
+        """Cumulative sum of delta and run-length encoding of the coverage in a single pass, writing runs to rows of runs."""
+        n = 0
+        depth = 0
+        run_start = 0
+        run_depth = 0
+        for i in range(delta.size - 1):
+            depth += delta[i]
+            if i == 0:
+                run_depth = depth
+            elif depth != run_depth:
+                if run_depth > 0 or bga:
+                    runs[n, 0] = run_start
+                    runs[n, 1] = i
+                    runs[n, 2] = run_depth
+                    n += 1
+                run_start = i
+                run_depth = depth
+
+        if delta.size > 1 and (run_depth > 0 or bga):
+            runs[n, 0] = run_start
+            runs[n, 1] = delta.size - 1
+            runs[n, 2] = run_depth
+            n += 1
+
+        return n
+
+
+def coverage_runs(
+    delta: np.ndarray,
+    bga: bool,
+    max_runs: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert a coverage difference array into runs of constant coverage (i.e. bedgraph intervals).
+
+    Args:
+        delta: Difference array for a contig (see difference_array)
+        bga: Include runs with zero coverage
+        max_runs: Upper bound on the number of runs (2 * number of intervals + 1)
+
+    Returns:
+        Tuple of arrays of 0-based start, exclusive end and coverage of each run
+    """
+    if not HAVE_NUMBA:
+        return _coverage_runs_numpy(delta, bga, max_runs)
+
+    runs = np.empty((max_runs, 3), dtype=np.int64)
+    n = _emit_runs(delta, bga, runs)
+    return runs[:n, 0], runs[:n, 1], runs[:n, 2]
+
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _write_int(value, buf, offset):
+        """Write the decimal digits of a non-negative integer to buf at offset, returning the new offset."""
+        n_digits = 1
+        remaining = value // 10
+        while remaining > 0:
+            n_digits += 1
+            remaining //= 10
+
+        end = offset + n_digits
+        for i in range(end - 1, offset - 1, -1):
+            buf[i] = 48 + value % 10
+            value //= 10
+
+        return end
+
+    @njit(cache=True)
+    def _format_runs(chrom, starts, ends, depths, buf):
+        """Write runs as bedgraph records (with integer depths) to buf, returning the number of bytes written."""
+        offset = 0
+        for i in range(starts.size):
+            buf[offset:offset + chrom.size] = chrom
+            offset += chrom.size
+            buf[offset] = 9  # '\t'
+            offset = _write_int(starts[i], buf, offset + 1)
+            buf[offset] = 9
+            offset = _write_int(ends[i], buf, offset + 1)
+            buf[offset] = 9
+            offset = _write_int(depths[i], buf, offset + 1)
+            buf[offset] = 10  # '\n'
+            offset += 1
+
+        return offset
+
+
+def write_bedgraph(
+    out: IO[bytes],
+    chrom: str,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    depths: np.ndarray,
+    scale: float
+) -> None:
+    """
+    Write runs of coverage on a contig as bedgraph records, as written by bedtools genomecov.
+
+    Records are formatted and written in chunks of at most _FORMAT_BUFSIZE bytes. Unscaled records are
+    written straight into a reused byte buffer if numba is installed, rather than formatting a string per record.
+
+    Args:
+        out: Binary file to write records to
+        chrom: Name of the contig
+        starts: 0-based start positions of the runs
+        ends: 0-based, exclusive end positions of the runs
+        depths: Coverage of each run
+        scale: Scale coverage by a constant factor
+    """
+    chrom_bytes = chrom.encode()
+    record_size = len(chrom_bytes) + 3 * (_MAX_DIGITS + 1)
+    chunk_runs = max(1, _FORMAT_BUFSIZE // record_size)
+
+    if HAVE_NUMBA and scale == 1.0 and (depths.size == 0 or depths.max() < _MAX_INTEGER_DEPTH):
+        chrom_array = np.frombuffer(chrom_bytes, dtype=np.uint8)
+        buf = np.empty(min(starts.size, chunk_runs) * record_size, dtype=np.uint8)
+        view = memoryview(buf)
+        for i in range(0, starts.size, chunk_runs):
+            chunk = slice(i, i + chunk_runs)
+            n = _format_runs(chrom_array, starts[chunk], ends[chunk], depths[chunk], buf)
+            out.write(view[:n])
+        return
+
+    for i in range(0, starts.size, chunk_runs):
+        chunk = slice(i, i + chunk_runs)
+        out.write("".join(
+            f"{chrom}\t{start}\t{end}\t{depth * scale:g}\n"
+            for start, end, depth in zip(starts[chunk].tolist(), ends[chunk].tolist(), depths[chunk].tolist())
+        ).encode())
@@ -0,0 +1,83 @@
+"""
+Shared pytest configuration and fixtures.
+"""
+import hashlib
+import shutil
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+
+import pytest
+
+import rnabam2cov
+import rnabam2cov.utils
+
+# Inputs that determine test outputs - the test data and the package source
+_INPUT_DIRS = (Path(__file__).parent / "data", Path(rnabam2cov.__file__).parent)
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--skip-unchanged",
+        action="store_true",
+        help=(
+            "Skip output tests that passed in a previous run, if the test file, conftest.py, test data, "
+            "rnabam2cov source and environment (numba, bedtools version) are unchanged"
+        )
+    )
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_makereport(item, call):
+    # Record the outcome of each phase on the test item, so fixtures can check whether the test passed
+    report = yield
+    setattr(item, f"rep_{report.when}", report)
+    return report
+
+
+@lru_cache(maxsize=1)
+def _environment() -> str:
+    """Describe the parts of the environment that change which code paths the tests exercise."""
+    bedtools = "none"
+    if shutil.which("bedtools"):
+        bedtools = subprocess.run(["bedtools", "--version"], capture_output=True, text=True).stdout.strip()
+    return f"numba={rnabam2cov.utils.HAVE_NUMBA}\tbedtools={bedtools}\n"
+
+
+def _inputs_fingerprint(test_path: Path) -> str:
+    """Get a hash of the size and modification time of all inputs to a test file, and of the environment."""
+    paths = [test_path, Path(__file__)]
+    for directory in _INPUT_DIRS:
+        paths.extend(sorted(directory.rglob("*")))
+
+    digest = hashlib.sha256(_environment().encode())
+    for path in paths:
+        if path.is_file() and "__pycache__" not in path.parts:
+            stat = path.stat()
+            digest.update(f"{path}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+@pytest.fixture
+def skip_unchanged(request):
+    """
+    With --skip-unchanged, skip a test that passed in a previous run with unchanged inputs (using pytest's cache).
+    Inputs are the test file, this conftest.py, the test data, the rnabam2cov source, whether numba is installed
+    and the bedtools version.
+
+    Without the option, tests always run.
+    """
+    if not request.config.getoption("--skip-unchanged"):
+        yield
+        return
+
+    key = f"rnabam2cov/passed/{request.node.nodeid}"
+    fingerprint = _inputs_fingerprint(request.node.path)
+    if request.config.cache.get(key, None) == fingerprint:
+        pytest.skip("unchanged since last passing run")
+
+    yield
+
+    report = getattr(request.node, "rep_call", None)
+    if report is not None and report.passed:
+        request.config.cache.set(key, fingerprint)
@@ -1,34 +1,30 @@
 """Tests for the command-line interface."""
-import os
+import filecmp
 import shutil
 import subprocess
-import tempfile
 from pathlib import Path
 
 import pytest
 
 from rnabam2cov import cli
 
+# Skip tests that run bedtools genomecov (the default) if it isn't installed
+requires_bedtools = pytest.mark.skipif(shutil.which("bedtools") is None, reason="bedtools is not installed")
 
-@pytest.fixture
-def temp_output_dir():
-    """Create a temporary directory for test outputs."""
-    temp_dir = tempfile.mkdtemp()
-    yield temp_dir
-    shutil.rmtree(temp_dir)
+@pytest.fixture(scope="module")
+def temp_output_dir(tmp_path_factory, request):
+    """Create a temporary directory for test outputs, shared by tests in the module."""
+    return tmp_path_factory.mktemp(request.module.__name__)
 
 
-def files_are_equal(file1, file2):
-    """Check if two files have the same content."""
-    with open(file1) as f1, open(file2) as f2:
-        return f1.read() == f2.read()
-
-
-def test_cli_basic_functionality(temp_output_dir):
-    """Test the basic functionality of the CLI with both strands."""
+@pytest.mark.parametrize("use_bedtools", [pytest.param(True, marks=requires_bedtools), False])
+def test_cli_basic_functionality(temp_output_dir, request, use_bedtools):
+    """Test the basic functionality of the CLI with both strands, with bedtools and in-process."""
     # Set up paths
     input_bam = "tests/data/example.forward.bam"
-    output_prefix = Path(temp_output_dir) / "coverage.example.forward"
+    output_prefix = temp_output_dir / f"{request.node.name}.coverage.example.forward"
+    plus_out = Path(f"{output_prefix}.plus.bedgraph")
+    minus_out = Path(f"{output_prefix}.minus.bedgraph")
     expected_plus = "tests/data/expected.forward.plus.bedgraph"
     expected_minus = "tests/data/expected.forward.minus.bedgraph"
     
@@ -36,25 +32,29 @@ def test_cli_basic_functionality(temp_output_dir):
     cli.rnabam2cov(
         bam_path=input_bam,
         libtype="forward",
-        output_prefix=str(output_prefix)
+        output_prefix=str(output_prefix),
+        use_bedtools=use_bedtools
     )
     
     # Check that both output files exist
-    assert os.path.exists(f"{output_prefix}.plus.bedgraph")
-    assert os.path.exists(f"{output_prefix}.minus.bedgraph")
+    assert plus_out.exists()
+    assert minus_out.exists()
     
     # Check that the output files match the expected files
-    assert files_are_equal(f"{output_prefix}.plus.bedgraph", expected_plus)
-    assert files_are_equal(f"{output_prefix}.minus.bedgraph", expected_minus)
+    assert filecmp.cmp(plus_out, expected_plus, shallow=False)
+    assert filecmp.cmp(minus_out, expected_minus, shallow=False)
 
 
-def test_cli_subprocess(temp_output_dir):
-    """Test the CLI by calling it as a subprocess."""
+@requires_bedtools
+@pytest.mark.smoke
+@pytest.mark.xdist_group("cli_subprocess")
+def test_cli_subprocess(temp_output_dir, request):
+    """Test the installed console script by calling it as a subprocess."""
     # Set up paths
     input_bam = "tests/data/example.forward.bam"
-    output_prefix = Path(temp_output_dir) / "coverage.example.forward"
-    expected_plus = "tests/data/expected.forward.plus.bedgraph"
-    expected_minus = "tests/data/expected.forward.minus.bedgraph"
+    output_prefix = temp_output_dir / f"{request.node.name}.coverage.example.forward"
+    plus_out = Path(f"{output_prefix}.plus.bedgraph")
+    minus_out = Path(f"{output_prefix}.minus.bedgraph")
     
     # Run CLI via subprocess
     result = subprocess.run([
@@ -67,20 +67,19 @@ def test_cli_subprocess(temp_output_dir):
     # Check subprocess execution
     assert result.returncode == 0
     
-    # Check that both output files exist
-    assert os.path.exists(f"{output_prefix}.plus.bedgraph")
-    assert os.path.exists(f"{output_prefix}.minus.bedgraph")
-    
-    # Check that the output files match the expected files
-    assert files_are_equal(f"{output_prefix}.plus.bedgraph", expected_plus)
-    assert files_are_equal(f"{output_prefix}.minus.bedgraph", expected_minus)
+    # Check that both output files exist (contents are checked via the Python API in test_cli_basic_functionality)
+    assert plus_out.exists()
+    assert minus_out.exists()
 
 
-def test_cli_single_strand(temp_output_dir):
-    """Test the CLI with only one strand specified."""
+@pytest.mark.parametrize("use_bedtools", [pytest.param(True, marks=requires_bedtools), False])
+def test_cli_single_strand(temp_output_dir, request, use_bedtools):
+    """Test the CLI with only one strand specified, with bedtools and in-process."""
     # Set up paths
     input_bam = "tests/data/example.forward.bam"
-    output_prefix = Path(temp_output_dir) / "coverage.example.forward"
+    output_prefix = temp_output_dir / f"{request.node.name}.coverage.example.forward"
+    plus_out = Path(f"{output_prefix}.plus.bedgraph")
+    minus_out = Path(f"{output_prefix}.minus.bedgraph")
     expected_plus = "tests/data/expected.forward.plus.bedgraph"
     
     # Run CLI via Python API with only plus strand
@@ -88,15 +87,53 @@ def test_cli_single_strand(temp_output_dir):
         bam_path=input_bam,
         libtype="forward",
         output_prefix=str(output_prefix),
-        strands=["+"]
+        strands=["+"],
+        use_bedtools=use_bedtools
     )
     
     # Check that only the plus strand file exists
-    assert os.path.exists(f"{output_prefix}.plus.bedgraph")
-    assert not os.path.exists(f"{output_prefix}.minus.bedgraph")
+    assert plus_out.exists()
+    assert not minus_out.exists()
     
     # Check that the output file matches the expected file
-    assert files_are_equal(f"{output_prefix}.plus.bedgraph", expected_plus)
+    assert filecmp.cmp(plus_out, expected_plus, shallow=False)
+
+@requires_bedtools
+@pytest.mark.parametrize("pc", [False, True])
+def test_cli_concurrent_strands(temp_output_dir, request, pc):
+    """Test that strands computed concurrently with bedtools match computing each strand on its own."""
+    input_bam = "tests/data/example.forward.bam"
+    output_prefix = temp_output_dir / f"{request.node.name}.coverage.example.forward"
+    
+    output_files = cli.rnabam2cov(bam_path=input_bam, libtype="forward", output_prefix=str(output_prefix), pc=pc)
+    
+    for strand, output_file in zip(["+", "-"], output_files):
+        serial_prefix = temp_output_dir / f"{request.node.name}.serial{strand}.coverage.example.forward"
+        serial_files = cli.rnabam2cov(
+            bam_path=input_bam,
+            libtype="forward",
+            output_prefix=str(serial_prefix),
+            strands=[strand],
+            pc=pc
+        )
+        assert filecmp.cmp(output_file, serial_files[0], shallow=False)
+
+
+def test_cli_duplicated_strand(temp_output_dir, request, monkeypatch):
+    """Test that a strand requested more than once is only computed once."""
+    output_prefix = temp_output_dir / f"{request.node.name}.coverage.example.forward"
+    calls = []
+    monkeypatch.setattr(cli, "get_stranded_coverage", lambda **kwargs: calls.append(kwargs) or "plus.bedgraph")
+    
+    output_files = cli.rnabam2cov(
+        bam_path="tests/data/example.forward.bam",
+        libtype="forward",
+        output_prefix=str(output_prefix),
+        strands=["+", "+"]
+    )
+    
+    assert output_files == ["plus.bedgraph", "plus.bedgraph"]
+    assert len(calls) == 1
 
 def test_cli_invalid_strand():
     """Test that the CLI raises an error for an invalid strand."""
@@ -153,42 +190,32 @@ def test_cli_mutually_exclusive_options():
         )
 
 
-def test_cli_subprocess_invalid_libtype(temp_output_dir):
-    """Test the CLI by calling it as a subprocess with an invalid library type."""
-    # Set up paths
-    input_bam = "tests/data/example.forward.bam"
-    output_prefix = Path(temp_output_dir) / "coverage.example.forward"
+def test_cli_main_invalid_libtype(capsys):
+    """Test the CLI entry point with an invalid library type."""
+    with pytest.raises(SystemExit) as exc:
+        cli.main([
+            "-i", "tests/data/example.forward.bam",
+            "--libtype", "invalid",
+            "-o", "output"
+        ])
     
-    # Run CLI via subprocess with invalid library type
-    result = subprocess.run([
-        "rnabam2cov",
-        "-i", input_bam,
-        "--libtype", "invalid",
-        "-o", str(output_prefix)
-    ], capture_output=True, text=True)
-    
-    # Check subprocess execution failed
-    assert result.returncode != 0
+    # Check execution failed
+    assert exc.value.code != 0
     # The actual error message is from argparse and will mention "invalid choice"
-    assert "invalid choice" in result.stderr
+    assert "invalid choice" in capsys.readouterr().err
 
 
-def test_cli_subprocess_invalid_strand(temp_output_dir):
-    """Test the CLI by calling it as a subprocess with an invalid strand."""
-    # Set up paths
-    input_bam = "tests/data/example.forward.bam"
-    output_prefix = Path(temp_output_dir) / "coverage.example.forward"
-    
-    # Run CLI via subprocess with invalid strand
-    result = subprocess.run([
-        "rnabam2cov",
-        "-i", input_bam,
-        "--libtype", "forward",
-        "-o", str(output_prefix),
-        "--strand", "invalid"
-    ], capture_output=True, text=True)
+def test_cli_main_invalid_strand(capsys):
+    """Test the CLI entry point with an invalid strand."""
+    with pytest.raises(SystemExit) as exc:
+        cli.main([
+            "-i", "tests/data/example.forward.bam",
+            "--libtype", "forward",
+            "-o", "output",
+            "--strand", "invalid"
+        ])
     
-    # Check subprocess execution failed
-    assert result.returncode != 0
+    # Check execution failed
+    assert exc.value.code != 0
     # Error message from argparse will mention valid choices
-    assert "error: argument --strand" in result.stderr
+    assert "error: argument --strand" in capsys.readouterr().err
@@ -1,63 +1,231 @@
+import filecmp
+import gzip
 import os
-import pytest
+import shutil
 from pathlib import Path
-import filecmp
-from rnabam2cov.coverage import get_stranded_bedgraph
+
+import pysam
+import pytest
+
+import rnabam2cov.coverage
+from rnabam2cov.coverage import (
+    _contig_batches,
+    _run_pipeline,
+    _samtools_view_argv,
+    get_stranded_bedgraph,
+    get_stranded_coverage_both_strands,
+)
 
 # Path to test data directory
 DATA_DIR = Path("tests/data")
 
-@pytest.fixture
-def forward_bam():
-    return DATA_DIR / "example.forward.bam"
+# Skip tests that run bedtools genomecov (or compare against it) if it isn't installed
+requires_bedtools = pytest.mark.skipif(shutil.which("bedtools") is None, reason="bedtools is not installed")
 
-@pytest.fixture
-def reverse_bam():
-    return DATA_DIR / "example.reverse.bam"
+def indexed_bam(tmp_path_factory, name):
+    """Get the path to a test BAM with an up-to-date index, indexing a link to it if the committed index is stale."""
+    bam = DATA_DIR / name
+    index = bam.with_name(f"{bam.name}.bai")
+    if index.exists() and index.stat().st_mtime >= bam.stat().st_mtime:
+        return bam
+    
+    link = tmp_path_factory.mktemp("bam") / name
+    link.symlink_to(bam.resolve())
+    pysam.index(str(link))
+    return link
+
+@pytest.fixture(scope="session")
+def forward_bam(tmp_path_factory):
+    return indexed_bam(tmp_path_factory, "example.forward.bam")
+
+@pytest.fixture(scope="session")
+def reverse_bam(tmp_path_factory):
+    return indexed_bam(tmp_path_factory, "example.reverse.bam")
+
+@pytest.fixture(scope="session")
+def edge_case_bam(tmp_path_factory):
+    """
+    Build an indexed BAM of reads covering edge cases of coverage options: spliced reads, deletions,
+    insertions, soft clips, single-end reads, paired reads whose mate is unmapped, and mapped reads
+    without aligned bases (a contig with only these reads has no coverage).
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [
+        {"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 500}, {"SN": "chr3", "LN": 300}
+    ]}
+    # (name, flag, contig, position, CIGAR)
+    reads = [
+        ("pair1", 99, 0, 10, "50M"),
+        ("spliced", 0, 0, 50, "20M100N30M"),
+        ("deletion", 16, 0, 60, "10M5D10M2I10M"),
+        ("pair1", 147, 0, 100, "50M"),
+        ("mate_unmapped_read2", 137, 0, 120, "30M"),
+        ("mate_unmapped_read2", 69, 0, 120, None),
+        ("mate_unmapped_read1", 89, 0, 200, "5S40M"),
+        ("mate_unmapped_read1", 165, 0, 200, None),
+        ("pair2", 163, 0, 210, "10M50N20M"),
+        ("pair2", 83, 0, 300, "30M"),
+        ("pair3", 97, 1, 5, "40M"),
+        ("pair3", 145, 1, 400, "25M3D5M"),
+        ("soft_clip_only", 0, 2, 20, "30S"),
+        ("no_cigar", 16, 2, 30, None),
+        ("insertion_only", 16, 2, 40, "5I"),
+    ]
+    
+    path = tmp_path_factory.mktemp("bam") / "edge_cases.bam"
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for name, flag, contig, position, cigar in reads:
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = contig
+            read.reference_start = position
+            read.next_reference_id = contig
+            if cigar is None:
+                read.query_sequence = "A" * 30
+            else:
+                read.cigarstring = cigar
+                read.query_sequence = "A" * read.infer_query_length()
+                read.mapping_quality = 60
+            bam.write(read)
+    pysam.index(str(path))
+    return path
 
 @pytest.fixture
 def temp_output_dir(tmpdir):
     return Path(tmpdir)
 
-def test_get_stranded_bedgraph_forward_plus(forward_bam, temp_output_dir):
-    """Test generating bedgraph for forward-stranded BAM, plus strand."""
-    output_prefix = temp_output_dir / "test.forward.plus"
+@pytest.fixture(scope="session")
+def stranded_bedgraph(tmp_path_factory):
+    """Run get_stranded_bedgraph, generating each bedgraph only once per session for the same arguments."""
+    output_dir = tmp_path_factory.mktemp("bedgraphs")
+    cache = {}
     
-    # Generate bedgraph with default settings
-    result = get_stranded_bedgraph(
-        bam_path=forward_bam,
-        strand="+",
-        output_prefix=output_prefix,
+    def run(bam_path, strand, **kwargs):
+        key = (bam_path, strand, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = get_stranded_bedgraph(
+                bam_path=bam_path,
+                strand=strand,
+                output_prefix=output_dir / str(len(cache)),
+                **kwargs
+            )
+        return cache[key]
+    
+    return run
+
+@pytest.mark.usefixtures("skip_unchanged")
+@pytest.mark.parametrize("bam_fixture,strand,bga,expected", [
+    ("forward_bam", "+", False, "expected.forward.plus.bedgraph"),
+    ("forward_bam", "-", False, "expected.forward.minus.bedgraph"),
+    # Note: expected files for the reverse-stranded BAM have opposite naming
+    ("reverse_bam", "+", False, "expected.reverse.minus.bedgraph"),
+    ("reverse_bam", "-", False, "expected.reverse.plus.bedgraph"),
+    ("forward_bam", "+", True, "expected.forward.plus.bga.bedgraph"),
+    ("reverse_bam", "-", True, "expected.reverse.plus.bga.bedgraph"),
+])
+def test_get_stranded_bedgraph(request, stranded_bedgraph, bam_fixture, strand, bga, expected):
+    """Test generating bedgraphs (with bg or bga) for each strand of forward- and reverse-stranded BAMs."""
+    result = stranded_bedgraph(
+        request.getfixturevalue(bam_fixture),
+        strand,
         split=True,
         du=True,
-        bg=True
+        bg=not bga,
+        bga=bga,
+        use_bedtools=False
     )
     
-    # Expected output file
-    expected_file = DATA_DIR / "expected.forward.plus.bedgraph"
-    
     # Check that the output file exists
     assert os.path.exists(result)
     
     # Compare with expected output
-    assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
+    assert filecmp.cmp(result, DATA_DIR / expected), "Generated bedgraph differs from expected"
+
+def test_get_stranded_bedgraph_max_depth(forward_bam, stranded_bedgraph):
+    """Test that max_depth has no effect on bedgraph output, as with bedtools genomecov."""
+    result = stranded_bedgraph(forward_bam, "+", max_depth=1, use_bedtools=False)
+    assert filecmp.cmp(result, DATA_DIR / "expected.forward.plus.bedgraph", shallow=False)
 
-def test_get_stranded_bedgraph_forward_minus(forward_bam, temp_output_dir):
-    """Test generating bedgraph for forward-stranded BAM, minus strand."""
-    output_prefix = temp_output_dir / "test.forward.minus"
+# Options of the in-process implementation that are compared against bedtools genomecov
+BEDTOOLS_OPTIONS = [
+    {},
+    {"split": False},
+    {"du": False},
+    {"ignoreD": True},
+    {"five_prime": True},
+    {"three_prime": True},
+    {"scale": 0.5},
+    {"trackline": True},
+    {"trackopts": 'name="test"'},
+    {"bg": False, "bga": True},
+    {"max_depth": 1},
+]
+
+@requires_bedtools
+@pytest.mark.usefixtures("skip_unchanged")
+@pytest.mark.parametrize("options", BEDTOOLS_OPTIONS, ids=lambda options: ",".join(options) or "default")
+@pytest.mark.parametrize("bam_fixture", ["forward_bam", "edge_case_bam"])
+def test_in_process_matches_bedtools(request, stranded_bedgraph, temp_output_dir, bam_fixture, options):
+    """Test that in-process coverage (single and both strands) is identical to bedtools genomecov output."""
+    bam = request.getfixturevalue(bam_fixture)
+    expected = {strand: stranded_bedgraph(bam, strand, use_bedtools=True, **options) for strand in "+-"}
+    
+    for strand in "+-":
+        result = stranded_bedgraph(bam, strand, use_bedtools=False, **options)
+        assert filecmp.cmp(result, expected[strand], shallow=False), f"Strand {strand} differs from bedtools"
+    
+    result = get_stranded_coverage_both_strands(
+        bam_path=bam,
+        output_prefix_plus=temp_output_dir / "test.plus",
+        output_prefix_minus=temp_output_dir / "test.minus",
+        libtype="forward",
+        **options
+    )
+    for strand in "+-":
+        assert filecmp.cmp(result[strand], expected[strand], shallow=False), f"Strand {strand} differs from bedtools"
+
+@pytest.mark.parametrize("options", [{}, {"five_prime": True}, {"bg": False, "bga": True}])
+def test_reads_without_aligned_bases(edge_case_bam, stranded_bedgraph, options):
+    """Test that mapped reads without aligned bases (e.g. CIGAR '30S', '5I' or '*') add no coverage."""
+    for strand in "+-":
+        with open(stranded_bedgraph(edge_case_bam, strand, use_bedtools=False, **options)) as bedgraph:
+            chr3 = [line for line in bedgraph if line.startswith("chr3\t")]
+        
+        if options.get("five_prime"):
+            # htslib gives reads with a CIGAR but no aligned bases a 1bp alignment, so their 5' ends are reported
+            assert chr3
+        elif options.get("bga"):
+            assert chr3 == ["chr3\t0\t300\t0\n"]
+        else:
+            assert chr3 == []
+
+def test_get_stranded_bedgraph_failure_cleanup(forward_bam, temp_output_dir, monkeypatch):
+    """Test that output files are removed if computing coverage in-process fails."""
+    def fail(*args, **kwargs):
+        raise RuntimeError("coverage failed")
+    monkeypatch.setattr(rnabam2cov.coverage, "_write_bedgraphs", fail)
     
+    output_prefix = temp_output_dir / "test.failed"
+    with pytest.raises(RuntimeError, match="coverage failed"):
+        get_stranded_bedgraph(
+            bam_path=forward_bam, strand="+", output_prefix=output_prefix, trackline=True, use_bedtools=False
+        )
+    assert list(temp_output_dir.iterdir()) == []
+
+def test_get_stranded_bedgraph_bedtools(forward_bam, stranded_bedgraph):
+    """Test generating bedgraph with a bedtools subprocess."""
     # Generate bedgraph with default settings
-    result = get_stranded_bedgraph(
-        bam_path=forward_bam,
-        strand="-",
-        output_prefix=output_prefix,
+    result = stranded_bedgraph(
+        forward_bam,
+        "+",
         split=True,
         du=True,
-        bg=True
+        bg=True,
+        use_bedtools=True
     )
     
     # Expected output file
-    expected_file = DATA_DIR / "expected.forward.minus.bedgraph"
+    expected_file = DATA_DIR / "expected.forward.plus.bedgraph"
     
     # Check that the output file exists
     assert os.path.exists(result)
@@ -65,22 +233,21 @@ def test_get_stranded_bedgraph_forward_minus(forward_bam, temp_output_dir):
     # Compare with expected output
     assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
 
-def test_get_stranded_bedgraph_reverse_plus(reverse_bam, temp_output_dir):
-    """Test generating bedgraph for reverse-stranded BAM, plus strand."""
-    output_prefix = temp_output_dir / "test.reverse.plus"
-    
+def test_get_stranded_bedgraph_pybedtools(forward_bam, stranded_bedgraph):
+    """Test generating bedgraph via pybedtools rather than a direct bedtools subprocess."""
     # Generate bedgraph with default settings
-    result = get_stranded_bedgraph(
-        bam_path=reverse_bam,
-        strand="+",
-        output_prefix=output_prefix,
+    result = stranded_bedgraph(
+        forward_bam,
+        "+",
         split=True,
         du=True,
-        bg=True
+        bg=True,
+        use_bedtools=True,
+        use_subprocess=False
     )
     
     # Expected output file
-    expected_file = DATA_DIR / "expected.reverse.minus.bedgraph"  # Note: expected file has opposite naming
+    expected_file = DATA_DIR / "expected.forward.plus.bedgraph"
     
     # Check that the output file exists
     assert os.path.exists(result)
@@ -88,77 +255,176 @@ def test_get_stranded_bedgraph_reverse_plus(reverse_bam, temp_output_dir):
     # Compare with expected output
     assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
 
-def test_get_stranded_bedgraph_reverse_minus(reverse_bam, temp_output_dir):
-    """Test generating bedgraph for reverse-stranded BAM, minus strand."""
-    output_prefix = temp_output_dir / "test.reverse.minus"
+@requires_bedtools
+@pytest.mark.skipif(
+    shutil.which("samtools") is None or shutil.which("bgzip") is None, reason="samtools/bgzip are not installed"
+)
+@pytest.mark.parametrize("options", [
+    {"bam_threads": 2},
+    {"bam_threads": 2, "bg": False, "bga": True},
+    {"bam_threads": 0, "compress": True},
+    {"bam_threads": 2, "bg": False, "bga": True, "compress": True},
+], ids=lambda options: ",".join(f"{key}={value}" for key, value in options.items()))
+def test_get_stranded_bedgraph_bedtools_pipeline(reverse_bam, stranded_bedgraph, options):
+    """
+    Test the samtools (decompression and restricting to contigs with reads) and bgzip stages of the bedtools
+    pipeline. Most contigs of the reverse-stranded BAM have no reads.
+    """
+    result = stranded_bedgraph(reverse_bam, "-", use_bedtools=True, **options)
     
-    # Generate bedgraph with default settings
-    result = get_stranded_bedgraph(
-        bam_path=reverse_bam,
-        strand="-",
-        output_prefix=output_prefix,
+    # Note: expected files for the reverse-stranded BAM have opposite naming
+    expected_file = DATA_DIR / f"expected.reverse.plus{'.bga' if options.get('bga') else ''}.bedgraph"
+    with (gzip.open if options.get("compress") else open)(result, "rb") as f, open(expected_file, "rb") as expected:
+        assert f.read() == expected.read(), "Generated bedgraph differs from expected"
+
+def test_get_stranded_bedgraph_compress(forward_bam, stranded_bedgraph):
+    """Test generating a gzip compressed bedgraph."""
+    result = stranded_bedgraph(
+        forward_bam,
+        "+",
         split=True,
         du=True,
-        bg=True
+        bg=True,
+        compress=True,
+        use_bedtools=False
     )
     
     # Expected output file
-    expected_file = DATA_DIR / "expected.reverse.plus.bedgraph"  # Note: expected file has opposite naming
+    expected_file = DATA_DIR / "expected.forward.plus.bedgraph"
     
-    # Check that the output file exists
+    # Check that the output file exists with the compressed extension
+    assert result.endswith(".bedgraph.gz")
     assert os.path.exists(result)
     
-    # Compare with expected output
-    assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
+    # Compare decompressed output with expected output
+    with gzip.open(result, "rb") as f, open(expected_file, "rb") as expected:
+        assert f.read() == expected.read(), "Decompressed bedgraph differs from expected"
 
-# Testing bga option
-def test_get_stranded_bedgraph_forward_plus_bga(forward_bam, temp_output_dir):
-    """Test generating bedgraph with bga for forward-stranded BAM, plus strand."""
-    output_prefix = temp_output_dir / "test.forward.plus.bga"
-    
-    # Generate bedgraph with bga settings
+def test_get_stranded_bedgraph_compress_subprocess(forward_bam, temp_output_dir, monkeypatch):
+    """Test that in-process output is compressed by an external compressor (e.g. bgzip) if available."""
+    monkeypatch.setattr(rnabam2cov.coverage, "_compressor_argv", lambda: ["gzip", "-c"])
     result = get_stranded_bedgraph(
         bam_path=forward_bam,
         strand="+",
-        output_prefix=output_prefix,
-        split=True,
-        du=True,
-        bg=False,
-        bga=True
+        output_prefix=temp_output_dir / "test.compress.subprocess",
+        compress=True,
+        use_bedtools=False
     )
     
-    # Expected output file
-    expected_file = DATA_DIR / "expected.forward.plus.bga.bedgraph"
+    with gzip.open(result, "rb") as f, open(DATA_DIR / "expected.forward.plus.bedgraph", "rb") as expected:
+        assert f.read() == expected.read(), "Decompressed bedgraph differs from expected"
+
+def test_get_stranded_bedgraph_compress_subprocess_failure(forward_bam, temp_output_dir, monkeypatch):
+    """Test that a failing compressor is reported, and its partial output removed."""
+    monkeypatch.setattr(rnabam2cov.coverage, "_compressor_argv", lambda: ["sh", "-c", "echo broken >&2; exit 3"])
     
-    # Check that the output file exists
-    assert os.path.exists(result)
+    with pytest.raises(RuntimeError, match="sh failed with exit code 3: broken"):
+        get_stranded_bedgraph(
+            bam_path=forward_bam,
+            strand="+",
+            output_prefix=temp_output_dir / "test.compress.failed",
+            compress=True,
+            use_bedtools=False
+        )
+    assert list(temp_output_dir.iterdir()) == []
+
+@pytest.mark.usefixtures("skip_unchanged")
+def test_get_stranded_coverage_both_strands_forward(forward_bam, temp_output_dir):
+    """Test generating bedgraphs for both strands in a single pass, forward-stranded BAM."""
+    result = get_stranded_coverage_both_strands(
+        bam_path=forward_bam,
+        output_prefix_plus=temp_output_dir / "test.forward.plus",
+        output_prefix_minus=temp_output_dir / "test.forward.minus",
+        libtype="forward"
+    )
+    
+    # Check that output files are assigned to the correct genomic strands
+    assert result == {
+        "+": f"{temp_output_dir / 'test.forward.plus'}.bedgraph",
+        "-": f"{temp_output_dir / 'test.forward.minus'}.bedgraph"
+    }
     
     # Compare with expected output
-    assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
+    assert filecmp.cmp(result["+"], DATA_DIR / "expected.forward.plus.bedgraph", shallow=False)
+    assert filecmp.cmp(result["-"], DATA_DIR / "expected.forward.minus.bedgraph", shallow=False)
 
-def test_get_stranded_bedgraph_reverse_minus_bga(reverse_bam, temp_output_dir):
-    """Test generating bedgraph with bga for reverse-stranded BAM, minus strand."""
-    output_prefix = temp_output_dir / "test.reverse.minus.bga"
-    
-    # Generate bedgraph with bga settings
-    result = get_stranded_bedgraph(
+@pytest.mark.usefixtures("skip_unchanged")
+def test_get_stranded_coverage_both_strands_reverse_bga(reverse_bam, temp_output_dir):
+    """Test generating bedgraphs (with bga) for both strands in a single pass, reverse-stranded BAM."""
+    result = get_stranded_coverage_both_strands(
         bam_path=reverse_bam,
-        strand="-",
-        output_prefix=output_prefix,
-        split=True,
-        du=True,
+        output_prefix_plus=temp_output_dir / "test.reverse.plus",
+        output_prefix_minus=temp_output_dir / "test.reverse.minus",
+        libtype="reverse",
         bg=False,
         bga=True
     )
     
-    # Expected output file
-    expected_file = DATA_DIR / "expected.reverse.plus.bga.bedgraph"  # Note: expected file has opposite naming
-    
-    # Check that the output file exists
-    assert os.path.exists(result)
+    # In reverse library type, genomic "+" strand corresponds to transcribed "-" strand
+    assert result == {
+        "+": f"{temp_output_dir / 'test.reverse.minus'}.bedgraph",
+        "-": f"{temp_output_dir / 'test.reverse.plus'}.bedgraph"
+    }
     
     # Compare with expected output
-    assert filecmp.cmp(result, expected_file), "Generated bedgraph differs from expected"
+    assert filecmp.cmp(result["+"], DATA_DIR / "expected.reverse.minus.bga.bedgraph", shallow=False)
+    assert filecmp.cmp(result["-"], DATA_DIR / "expected.reverse.plus.bga.bedgraph", shallow=False)
+
+@pytest.mark.usefixtures("skip_unchanged")
+def test_get_stranded_coverage_both_strands_parallel(forward_bam, temp_output_dir, monkeypatch):
+    """Test that computing coverage of contigs in parallel gives identical output."""
+    # The test BAM is far too small to be processed in parallel by default
+    monkeypatch.setattr(rnabam2cov.coverage, "PARALLEL_MIN_READS", 0)
+    result = get_stranded_coverage_both_strands(
+        bam_path=forward_bam,
+        output_prefix_plus=temp_output_dir / "test.forward.plus",
+        output_prefix_minus=temp_output_dir / "test.forward.minus",
+        libtype="forward",
+        bg=False,
+        bga=True,
+        threads=2
+    )
+
+    assert filecmp.cmp(result["+"], DATA_DIR / "expected.forward.plus.bga.bedgraph", shallow=False)
+    assert filecmp.cmp(result["-"], DATA_DIR / "expected.forward.minus.bga.bedgraph", shallow=False)
+
+    # Shard files are cleaned up
+    assert sorted(p.name for p in temp_output_dir.iterdir()) == [
+        "test.forward.minus.bedgraph", "test.forward.plus.bedgraph"
+    ]
+
+def test_contig_batches(monkeypatch):
+    """Test that contigs without reads are dropped and small contigs are batched together."""
+    mapped_reads = {"chr1": 600, "chr2": 0, "chr3": 100, "chr4": 100, "chr5": 200, "chrM": 0}
+    assert _contig_batches(mapped_reads, threads=2) == []
+    
+    monkeypatch.setattr(rnabam2cov.coverage, "PARALLEL_MIN_READS", 0)
+    monkeypatch.setattr(rnabam2cov.coverage, "_BATCHES_PER_WORKER", 1)
+    assert _contig_batches(mapped_reads, threads=2) == [["chr1"], ["chr3", "chr4", "chr5"]]
+
+def test_samtools_view_argv_regions():
+    """Test that contig names are quoted, so names containing ':' or '-' aren't parsed as region ranges."""
+    argv = _samtools_view_argv("in.bam", 2, ["chr1", "HLA-A*01:01:01:01"])
+    assert argv == ["samtools", "view", "-@", "2", "-u", "in.bam", "{chr1}", "{HLA-A*01:01:01:01}"]
+
+def test_get_stranded_bedgraph_bedtools_no_mapped_reads(temp_output_dir):
+    """Test that a BAM without mapped reads gives bedtools output without running bedtools."""
+    bam_path = temp_output_dir / "empty.bam"
+    with pysam.AlignmentFile(bam_path, "wb", reference_names=["chr1", "chr2"], reference_lengths=[100, 50]):
+        pass
+    pysam.index(str(bam_path))
+    
+    result = get_stranded_bedgraph(
+        bam_path=bam_path,
+        strand="+",
+        output_prefix=temp_output_dir / "test.empty",
+        bg=False,
+        bga=True,
+        use_bedtools=True
+    )
+    
+    with open(result) as f:
+        assert f.read() == "chr1\t0\t100\t0\nchr2\t0\t50\t0\n"
 
 # Test error cases
 def test_invalid_strand(forward_bam, temp_output_dir):
@@ -209,4 +475,17 @@ def test_mutually_exclusive_5_3_prime(forward_bam, temp_output_dir):
             output_prefix=output_prefix,
             five_prime=True,
             three_prime=True
-        )
\ No newline at end of file
+        )
+
+def test_run_pipeline_failure_cleanup(temp_output_dir):
+    """Test that a failed pipeline reports the failing stage and removes its partial output."""
+    output_path = temp_output_dir / "test.pipeline.failed.txt"
+    
+    with pytest.raises(RuntimeError, match="false failed with exit code 1"):
+        _run_pipeline([["echo", "partial"], ["false"]], str(output_path))
+    assert not output_path.exists()
+    
+    # A stage that can't be started doesn't leave earlier stages running
+    with pytest.raises(FileNotFoundError):
+        _run_pipeline([["yes"], ["rnabam2cov-no-such-command"]], str(output_path))
+    assert not output_path.exists()
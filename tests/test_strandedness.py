@@ -34,6 +34,12 @@ def test_get_strand_mapping_case_insensitive():
     assert get_strand_mapping("REVERSE") == get_strand_mapping("reverse")
 
 
+def test_get_strand_mapping_enum():
+    """Test get_strand_mapping accepts LibraryType members."""
+    assert get_strand_mapping(LibraryType.FORWARD) == get_strand_mapping("forward")
+    assert get_strand_mapping(LibraryType.REVERSE) == get_strand_mapping("reverse")
+
+
 def test_get_strand_mapping_invalid():
     """Test get_strand_mapping with invalid strandedness."""
     with pytest.raises(ValueError):
@@ -57,4 +63,11 @@ def test_get_output_prefixes_reverse():
 def test_get_output_prefixes_with_path():
     """Test get_output_prefixes with a path in the prefix."""
     prefixes = get_output_prefixes("/path/to/test", "forward")
-    assert prefixes == {"+": "/path/to/test.plus", "-": "/path/to/test.minus"}
\ No newline at end of file
+    assert prefixes == {"+": "/path/to/test.plus", "-": "/path/to/test.minus"}
+
+def test_get_output_prefixes_cached():
+    """Test get_output_prefixes returns the same read-only mapping for repeated calls."""
+    prefixes = get_output_prefixes("test", "forward")
+    assert get_output_prefixes("test", "forward") is prefixes
+    with pytest.raises(TypeError):
+        prefixes["+"] = "other"
@@ -0,0 +1,83 @@
+"""
+Tests for the utils module.
+"""
+import io
+
+import numpy as np
+import pytest
+
+import rnabam2cov.utils
+from rnabam2cov.utils import coverage_runs, difference_array, write_bedgraph
+
+
+@pytest.fixture(autouse=True, params=["numba", "numpy"])
+def implementation(request, monkeypatch):
+    """Run each test with both the numba and NumPy implementations, which must give identical results."""
+    if request.param == "numba" and not rnabam2cov.utils.HAVE_NUMBA:
+        pytest.skip("numba is not installed")
+    if request.param == "numpy":
+        monkeypatch.setattr(rnabam2cov.utils, "HAVE_NUMBA", False)
+    return request.param
+
+
+def test_difference_array():
+    """Test difference_array adds +1/-1 at interval starts/ends."""
+    delta = difference_array(np.array([0, 2, 2]), np.array([3, 4, 10]), 5)
+    assert delta.tolist() == [1, 0, 2, -1, -1, -1]
+
+
+def test_difference_array_dtype():
+    """Test difference_array only uses int16 when coverage can't overflow."""
+    starts = np.zeros(32767, dtype=np.int64)
+    assert difference_array(starts, starts + 1, 10).dtype == np.int16
+
+    starts = np.zeros(32768, dtype=np.int64)
+    delta = difference_array(starts, starts + 1, 10)
+    assert delta.dtype == np.int32
+    assert delta[0] == 32768
+
+
+def test_coverage_runs():
+    """Test coverage_runs reports runs of non-zero coverage."""
+    delta = difference_array(np.array([2, 4]), np.array([6, 5]), 10)
+    starts, ends, depths = coverage_runs(delta, bga=False, max_runs=5)
+    assert list(zip(starts.tolist(), ends.tolist(), depths.tolist())) == [(2, 4, 1), (4, 5, 2), (5, 6, 1)]
+
+
+def test_coverage_runs_bga():
+    """Test coverage_runs with zero coverage runs."""
+    delta = difference_array(np.array([2, 4]), np.array([6, 5]), 10)
+    starts, ends, depths = coverage_runs(delta, bga=True, max_runs=5)
+    assert list(zip(starts.tolist(), ends.tolist(), depths.tolist())) == [
+        (0, 2, 0), (2, 4, 1), (4, 5, 2), (5, 6, 1), (6, 10, 0)
+    ]
+
+
+def bedgraph(chrom, starts, ends, depths, scale):
+    """Get the records written by write_bedgraph."""
+    out = io.BytesIO()
+    write_bedgraph(out, chrom, starts, ends, depths, scale)
+    return out.getvalue()
+
+
+def test_write_bedgraph():
+    """Test write_bedgraph formats depths as bedtools does."""
+    starts, ends, depths = np.array([0, 9]), np.array([9, 1000000]), np.array([0, 123])
+    assert bedgraph("chr1", starts, ends, depths, 1.0) == b"chr1\t0\t9\t0\nchr1\t9\t1000000\t123\n"
+    assert bedgraph("chr1", starts, ends, depths, 0.5) == b"chr1\t0\t9\t0\nchr1\t9\t1000000\t61.5\n"
+
+    # Large depths are reported in scientific notation
+    assert bedgraph("chr1", starts[:1], ends[:1], np.array([1000000]), 1.0) == b"chr1\t0\t9\t1e+06\n"
+
+
+def test_write_bedgraph_chunks(monkeypatch):
+    """Test write_bedgraph gives the same output when records are formatted in several chunks."""
+    starts, ends, depths = np.arange(0, 100, 10), np.arange(10, 110, 10), np.arange(1, 11)
+    expected = bedgraph("chr1", starts, ends, depths, 1.0)
+
+    # Room for two records per chunk
+    monkeypatch.setattr(rnabam2cov.utils, "_FORMAT_BUFSIZE", 2 * (4 + 3 * (rnabam2cov.utils._MAX_DIGITS + 1)))
+    assert bedgraph("chr1", starts, ends, depths, 1.0) == expected
+    assert bedgraph("chr1", starts, ends, depths, 0.5) == "".join(
+        f"chr1\t{start}\t{start + 10}\t{(start // 10 + 1) * 0.5:g}\n" for start in range(0, 100, 10)
+    ).encode()